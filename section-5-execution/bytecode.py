@@ -0,0 +1,140 @@
+"""
+A binary format for compiled chunks, so they can be saved and run later
+without scanning or compiling their source again.
+
+All integers are 4 byte little endian. The file starts with a header:
+
+    magic            "CALC"
+    version          FORMAT_VERSION
+    max stack depth
+    code length      in bytes
+    constant count
+    checksum         the CRC-32 of everything after the header
+
+followed by the constants, each an 8 byte little endian IEEE double, and
+then the code bytes. The constants come first so they stay 8 byte aligned.
+"""
+from chunk import Chunk
+from opcodes import OpCode
+from rpython.rlib.longlong2float import float2longlong, longlong2float
+from rpython.rlib.rarithmetic import intmask, r_uint64
+from rpython.rlib.rstring import StringBuilder
+from rpython.rlib.rzipfile import crc32
+from rpython.rtyper.lltypesystem import lltype, rffi
+
+MAGIC = "CALC"
+# 2 added the OP_*_CONST superinstructions and OP_LOAD_VAR
+FORMAT_VERSION = 2
+HEADER_SIZE = 24
+
+
+class BytecodeError(Exception):
+    def __init__(self, message):
+        self.message = message
+
+
+def _write_int(builder, value):
+    for shift in range(0, 32, 8):
+        builder.append(chr((value >> shift) & 0xff))
+
+
+def _read_int(data, pos):
+    return (ord(data[pos]) | (ord(data[pos + 1]) << 8) |
+            (ord(data[pos + 2]) << 16) | (ord(data[pos + 3]) << 24))
+
+
+def read_double(data, pos):
+    """
+    The little endian IEEE double at data[pos:pos + 8].
+    """
+    # Unsigned, so a set sign bit can't overflow, then cast once
+    bits = r_uint64(0)
+    for j in range(8):
+        bits |= r_uint64(ord(data[pos + j])) << (8 * j)
+    return longlong2float(rffi.cast(lltype.SignedLongLong, bits))
+
+
+def dump_chunk(chunk):
+    """
+    The chunk serialized as a string.
+    """
+    max_stack_depth = chunk.max_stack_depth
+    if max_stack_depth < 0:
+        max_stack_depth = chunk.compute_max_stack_depth()
+
+    body = StringBuilder(8 * len(chunk.constants) + len(chunk.code))
+    for value in chunk.constants:
+        bits = float2longlong(value)
+        for shift in range(0, 64, 8):
+            body.append(chr(intmask(bits >> shift) & 0xff))
+    body.append("".join(chunk.code))
+    body = body.build()
+
+    header = StringBuilder(HEADER_SIZE)
+    header.append(MAGIC)
+    _write_int(header, FORMAT_VERSION)
+    _write_int(header, max_stack_depth)
+    _write_int(header, len(chunk.code))
+    _write_int(header, len(chunk.constants))
+    _write_int(header, intmask(crc32(body)))
+    return header.build() + body
+
+
+def load_chunk(data):
+    """
+    The chunk serialized in data. Raises BytecodeError if data isn't a
+    valid chunk in this version of the format.
+    """
+    if len(data) < HEADER_SIZE or not data.startswith(MAGIC):
+        raise BytecodeError("not a bytecode file")
+    version = _read_int(data, 4)
+    if version != FORMAT_VERSION:
+        raise BytecodeError("unsupported bytecode version %d" % version)
+    max_stack_depth = _read_int(data, 8)
+    code_length = _read_int(data, 12)
+    constant_count = _read_int(data, 16)
+    if len(data) != HEADER_SIZE + 8 * constant_count + code_length:
+        raise BytecodeError("bytecode file has the wrong size")
+    body = data[HEADER_SIZE:]
+    if intmask(crc32(body)) != _read_int(data, 20):
+        raise BytecodeError("bytecode checksum mismatch")
+
+    chunk = Chunk()
+    pos = 0
+    for i in range(constant_count):
+        chunk.constants.append(read_double(body, pos))
+        pos += 8
+    for i in range(code_length):
+        chunk.code.append(body[pos + i])
+
+    # The checksum only catches accidents, so make sure the code can't
+    # index outside the stack or constant pool either. The VM checks the
+    # variable slots against the variables it's given.
+    chunk.max_stack_depth = chunk.compute_max_stack_depth()
+    if (chunk.max_stack_depth < 0 or
+            chunk.max_stack_depth != max_stack_depth or
+            not _check_operands(chunk)):
+        raise BytecodeError("invalid bytecode")
+    return chunk
+
+
+def _check_operands(chunk):
+    """
+    Check every constant index is in the pool, and find the chunk's
+    variable_count.
+    """
+    # compute_max_stack_depth has checked the code up to the first
+    # OP_RETURN, nothing after that is run.
+    offset = 0
+    while True:
+        instruction = chunk.get_code(offset)
+        if instruction == OpCode.OP_RETURN:
+            return True
+        if instruction == OpCode.OP_LOAD_VAR:
+            slot = chunk.get_code(offset + 1)
+            if slot >= chunk.variable_count:
+                chunk.variable_count = slot + 1
+        elif instruction in OpCode.OperandBytes:
+            if chunk.read_constant_index(offset) >= len(chunk.constants):
+                return False
+        offset += 1 + OpCode.OperandBytes.get(instruction, 0)
@@ -0,0 +1,99 @@
+from scanner import Scanner, TokenTypes
+
+
+def normalize_source(source):
+    """
+    Returns the source's tokens separated by single spaces, so sources that
+    only differ in whitespace and comments have the same key. Returns None
+    if the source doesn't scan, such sources are never cached.
+    """
+    scanner = Scanner(source)
+    tokens = scanner.scan_all()
+    parts = []
+    for i in range(tokens.size()):
+        token_type = tokens.types[i]
+        if token_type == TokenTypes.ERROR:
+            return None
+        if token_type != TokenTypes.EOF:
+            parts.append(scanner.get_text(tokens.starts[i],
+                                          tokens.lengths[i]))
+    return " ".join(parts)
+
+
+class CacheEntry(object):
+    def __init__(self, key, chunk):
+        self.key = key
+        self.chunk = chunk
+        self.newer = None
+        self.older = None
+
+
+class ChunkCache(object):
+    """
+    A least recently used cache of compiled chunks, keyed by normalized
+    source.
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.entries = {}
+        # A doubly linked list of entries, from most to least recently used
+        self.newest = None
+        self.oldest = None
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        if key not in self.entries:
+            self.misses += 1
+            return None
+        self.hits += 1
+        entry = self.entries[key]
+        self._unlink(entry)
+        self._link_newest(entry)
+        return entry.chunk
+
+    def put(self, key, chunk):
+        if self.capacity <= 0:
+            return
+        if key in self.entries:
+            entry = self.entries[key]
+            entry.chunk = chunk
+            self._unlink(entry)
+            self._link_newest(entry)
+            return
+        if len(self.entries) >= self.capacity:
+            oldest = self.oldest
+            self._unlink(oldest)
+            del self.entries[oldest.key]
+            self.evictions += 1
+        entry = CacheEntry(key, chunk)
+        self.entries[key] = entry
+        self._link_newest(entry)
+
+    def _unlink(self, entry):
+        if entry.newer is None:
+            self.newest = entry.older
+        else:
+            entry.newer.older = entry.older
+        if entry.older is None:
+            self.oldest = entry.newer
+        else:
+            entry.older.newer = entry.newer
+        entry.newer = None
+        entry.older = None
+
+    def _link_newest(self, entry):
+        entry.older = self.newest
+        if self.newest is None:
+            self.oldest = entry
+        else:
+            self.newest.newer = entry
+        self.newest = entry
+
+    def stats(self):
+        return "cache: %d hits, %d misses, %d evictions, %d/%d entries" % (
+            self.hits, self.misses, self.evictions,
+            len(self.entries), self.capacity)
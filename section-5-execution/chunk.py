@@ -1,17 +1,76 @@
 from debug import disassemble_instruction
+from opcodes import OpCode
+from rpython.rlib import jit
+import math
 
 
 class Chunk:
+    # The lists themselves are never replaced, and once the compiler has
+    # finished with a chunk their contents don't change either.
+    _immutable_fields_ = ['code', 'constants']
+
+    # The largest constant pool OP_CONSTANT_LONG can index
+    MAX_CONSTANTS = 1 << 24
+
     code = None
     constants = None
 
     def __init__(self):
+        # The code is a list of chars rather than ints, which translates
+        # to a growable array of bytes rather than of machine words. The
+        # constants translate to an array of unboxed floats.
         self.code = []
         self.constants = []
+        # The most values the code will ever have on the stack, or -1 if
+        # that hasn't been worked out yet.
+        self.max_stack_depth = -1
+        # Constant indexes keyed by value. -0.0 == 0.0 so zeros can't be
+        # told apart by the dict, they are indexed separately by sign.
         self._constants = {}
+        self._zero = -1
+        self._negative_zero = -1
+        # The number of variable slots the code loads from
+        self.variable_count = 0
+        # The code translated for the RegisterVM, once it has been, or
+        # whether it couldn't be
+        self.register_code = None
+        self.register_failed = False
 
     def write_chunk(self, byte):
-        self.code.append(byte)
+        self.code.append(chr(byte))
+
+    def write_constant(self, index):
+        """
+        Write an instruction loading the constant at `index`, using the
+        short form whenever the index fits in a single byte.
+        """
+        if index < 256:
+            self.write_chunk(OpCode.OP_CONSTANT)
+            self.write_chunk(index)
+        else:
+            self.write_chunk(OpCode.OP_CONSTANT_LONG)
+            self.write_chunk(index & 0xff)
+            self.write_chunk((index >> 8) & 0xff)
+            self.write_chunk((index >> 16) & 0xff)
+
+    def read_constant_index(self, offset):
+        """
+        The constant index of the instruction at `offset`, any of those
+        with a constant operand.
+        """
+        if self.get_code(offset) != OpCode.OP_CONSTANT_LONG:
+            return self.get_code(offset + 1)
+        return (self.get_code(offset + 1) |
+                (self.get_code(offset + 2) << 8) |
+                (self.get_code(offset + 3) << 16))
+
+    @jit.elidable
+    def get_code(self, offset):
+        return ord(self.code[offset])
+
+    @jit.elidable
+    def get_constant(self, index):
+        return self.constants[index]
 
     def disassemble(self, name):
         print "== %s ==\n" % name
@@ -19,12 +78,76 @@ class Chunk:
         while i < len(self.code):
             i = disassemble_instruction(self, i)
 
+    def compute_max_stack_depth(self):
+        """
+        Walk the code summing each instruction's stack effect to find the
+        deepest the stack gets. Returns -1 if the code is invalid: if it
+        would pop from an empty stack or doesn't end with an OP_RETURN.
+        """
+        depth = 0
+        max_depth = 0
+        offset = 0
+        while offset < len(self.code):
+            instruction = self.get_code(offset)
+            if instruction not in OpCode.StackEffects:
+                return -1
+            depth += OpCode.StackEffects[instruction]
+            if depth < 0:
+                return -1
+            if depth > max_depth:
+                max_depth = depth
+            offset += 1 + OpCode.OperandBytes.get(instruction, 0)
+            if instruction == OpCode.OP_RETURN:
+                if offset > len(self.code):
+                    return -1
+                return max_depth
+        return -1
+
+    def truncate_constants(self, size):
+        """
+        Forget the constants added after the pool had `size` entries.
+        """
+        while len(self.constants) > size:
+            value = self.constants.pop()
+            if value in self._constants:
+                del self._constants[value]
+        if self._zero >= size:
+            self._zero = -1
+        if self._negative_zero >= size:
+            self._negative_zero = -1
+
     def add_constant(self, value):
-        # See if we already know this constant
+        # See if we already know this constant. A nan is never equal to a
+        # known constant so always gets a new entry.
+        if value == 0.0:
+            if math.copysign(1.0, value) < 0.0:
+                if self._negative_zero < 0:
+                    self._negative_zero = self._append_constant(value)
+                return self._negative_zero
+            if self._zero < 0:
+                self._zero = self._append_constant(value)
+            return self._zero
         if value in self._constants:
             return self._constants[value]
-        else:
-            index = len(self._constants)
-            self.constants.append(value)
+        index = self._append_constant(value)
+        if value == value:
             self._constants[value] = index
-            return index
+        return index
+
+    def _append_constant(self, value):
+        self.constants.append(value)
+        return len(self.constants) - 1
+
+    def memory_report(self):
+        """
+        The bytes taken by the chunk's code, its constants and the index
+        of its constants, leaving out list and dict overheads.
+        """
+        code_size = len(self.code)
+        constants_size = 8 * len(self.constants)
+        # A float key and an int index per entry
+        index_size = 16 * len(self._constants)
+        return ("chunk: %d bytes of code, %d bytes of constants, "
+                "%d bytes of constant index, %d bytes in all" % (
+                    code_size, constants_size, index_size,
+                    code_size + constants_size + index_size))
@@ -0,0 +1,154 @@
+"""
+Input rows for evaluating one compiled expression many times, with its
+variables bound to each row's values in turn.
+"""
+from bytecode import read_double
+
+# How much of a mapped file is copied out at a time
+WINDOW_SIZE = 2**20
+# The rows read from a file at a time
+BLOCK_ROWS = 2**12
+
+
+class ColumnError(Exception):
+    def __init__(self, message):
+        self.message = message
+
+
+class Rows(object):
+    """
+    Rows of values held as columns, a list of floats per name, with the
+    values of each row bound to the variables `names` by position. The
+    readers of files below refill the columns a block of rows at a time.
+    """
+
+    def __init__(self, names, columns):
+        self.names = names
+        self.columns = columns
+        # The rows in the columns, and the next one to read
+        self.block_rows = 0
+        if columns:
+            self.block_rows = len(columns[0])
+        self.row = 0
+
+    def next_row(self, values):
+        """
+        Read the next row into values, which has a slot per name,
+        returning False after the last row. Raises ColumnError if the
+        input is malformed.
+        """
+        if self.row >= self.block_rows:
+            self.block_rows = self._read_block()
+            self.row = 0
+            if self.block_rows == 0:
+                return False
+        for i in range(len(self.columns)):
+            values[i] = self.columns[i][self.row]
+        self.row += 1
+        return True
+
+    def _read_block(self):
+        """
+        Read the next rows into the columns, returning how many were read.
+        Rows given as columns have none but those.
+        """
+        return 0
+
+
+class CsvRows(Rows):
+    """
+    Comma separated values, with a header line of names. Blank lines are
+    skipped.
+    """
+
+    def __init__(self, mapped):
+        Rows.__init__(self, [], [])
+        self.mapped = mapped
+        self.window = ""
+        self.window_pos = 0
+        self.pos = 0
+        self.line_number = 0
+        header = self._next_line()
+        if header is None:
+            raise ColumnError("no header line")
+        for name in header.split(","):
+            self.names.append(name.strip())
+        for name in self.names:
+            self.columns.append([0.0] * BLOCK_ROWS)
+
+    def _next_line(self):
+        """
+        The next line that isn't blank, without its newline, or None at
+        the end.
+        """
+        while True:
+            if self.window_pos >= len(self.window):
+                if self.pos >= self.mapped.size:
+                    return None
+                end = self.mapped.window_end(self.pos, WINDOW_SIZE)
+                self.window = self.mapped.window(self.pos, end)
+                self.window_pos = 0
+                self.pos = end
+            start = self.window_pos
+            assert start >= 0
+            end = self.window.find('\n', start)
+            if end == -1:
+                end = len(self.window)
+            assert end >= 0
+            self.window_pos = end + 1
+            self.line_number += 1
+            line = self.window[start:end].strip()
+            if line:
+                return line
+
+    def _read_block(self):
+        rows = 0
+        while rows < BLOCK_ROWS:
+            line = self._next_line()
+            if line is None:
+                break
+            fields = line.split(",")
+            if len(fields) != len(self.names):
+                raise ColumnError("line %d: expected %d fields, found %d" % (
+                    self.line_number, len(self.names), len(fields)))
+            for i in range(len(fields)):
+                try:
+                    self.columns[i][rows] = float(fields[i].strip())
+                except ValueError:
+                    raise ColumnError("line %d: not a number: %s" % (
+                        self.line_number, fields[i]))
+            rows += 1
+        return rows
+
+
+class RawColumns(Rows):
+    """
+    Columns of little endian IEEE doubles, one after the other, each with
+    a value per row.
+    """
+
+    def __init__(self, mapped, names):
+        Rows.__init__(self, names, [])
+        self.mapped = mapped
+        for name in names:
+            self.columns.append([0.0] * BLOCK_ROWS)
+        column_size = 8 * len(names)
+        if column_size == 0 or mapped.size % column_size != 0:
+            raise ColumnError("size isn't a whole number of rows")
+        self.row_count = mapped.size // column_size
+        # The first row of the next block
+        self.next_block = 0
+
+    def _read_block(self):
+        rows = min(BLOCK_ROWS, self.row_count - self.next_block)
+        if rows == 0:
+            # An empty file has no mapping to take a window of
+            return 0
+        for i in range(len(self.columns)):
+            pos = 8 * (i * self.row_count + self.next_block)
+            data = self.mapped.window(pos, pos + 8 * rows)
+            column = self.columns[i]
+            for j in range(rows):
+                column[j] = read_double(data, 8 * j)
+        self.next_block += rows
+        return rows
@@ -1,7 +1,7 @@
 # coding=utf-8
 from chunk import Chunk
 from opcodes import OpCode
-from scanner import Scanner, TokenTypes
+from scanner import Scanner, Token, TokenTypes
 
 
 class Parser(object):
@@ -29,16 +29,72 @@ class ParseRule(object):
         self.precedence = precedence
 
 
+class PendingRule(object):
+    """
+    A parse rule that is waiting for an operand to be compiled, used by
+    the iterative parser in place of a native stack frame.
+    """
+
+    def __init__(self, operand_precedence, kind, op_type,
+                 left_at, left, pool_mark):
+        self.operand_precedence = operand_precedence
+        # The precedence to carry on parsing at once the rule is finished
+        self.precedence = Precedence.NONE
+        self.kind = kind
+        self.op_type = op_type
+        # The constant folding state of a binary rule's left operand
+        self.left_at = left_at
+        self.left = left
+        self.pool_mark = pool_mark
+
+
 class Compiler(object):
 
-    def __init__(self, source, debugging=True):
+    def __init__(self, source, debugging=True, fold_constants=False,
+                 iterative=False, token_stream=False, scanner=None,
+                 superinstructions=False, variables=None, output=None):
         self.parser = Parser()
-        self.scanner = Scanner(source)
+        # Error messages are written to output if one is given, so they
+        # stay in order with the results written there, or else printed.
+        self.output = output
+        # A scanner can be given in place of the source, to compile input
+        # that isn't held in a string, such as a StreamScanner.
+        if scanner is None:
+            scanner = Scanner(source)
+        self.scanner = scanner
         # The chunk of bytecode we are currently assembling
         self.chunk = Chunk()
         self.DEBUG_PRINT_CODE = debugging
+        self.FOLD_CONSTANTS = fold_constants
+        # Emit a binary op with a constant right operand as one of the
+        # OP_*_CONST superinstructions
+        self.SUPERINSTRUCTIONS = superinstructions
+        # The slot of each variable name, its index in `variables`
+        self.variables = {}
+        if variables is not None:
+            for i in range(len(variables)):
+                self.variables[variables[i]] = i
+        # Parse with an explicit stack instead of recursing, so nesting
+        # depth is limited by memory rather than the native stack.
+        self.ITERATIVE = iterative
+        self.pending = []
+        # Scan the whole source up front into a TokenStream and parse from
+        # that, rather than scanning a Token object at a time.
+        self.TOKEN_STREAM = token_stream
+        self.tokens = None
+        self.token_index = 0
+        self.number_index = 0
+        self.name_index = 0
+        # Where the most recently emitted OP_CONSTANT starts, as long as
+        # nothing has been emitted after it, the value it loads and the size
+        # of the constant pool before it was added.
+        self.constant_at = -1
+        self.constant_value = 0.0
+        self.constant_pool_mark = 0
 
     def compile(self):
+        if self.TOKEN_STREAM:
+            self.tokens = self.scanner.scan_all()
         self.advance()
         self.expression()
         self.consume(TokenTypes.EOF, "Expect end of expression.")
@@ -50,15 +106,19 @@ class Compiler(object):
         if self.parser.panic_mode:
             # suppress subsequent errors
             return
-        print "[error detected at character %d]" % token.start
+        message = "[error detected at character %d]\n" % token.start
 
         if token.type == TokenTypes.EOF:
-            print " at end"
+            message += " at end\n"
         elif token.type == TokenTypes.ERROR:
             pass
         else:
-            print " at %s" % self.scanner.get_token_string(token)
-        print ": %s\n" % msg
+            message += " at %s\n" % self.scanner.get_token_string(token)
+        message += ": %s\n" % msg
+        if self.output is not None:
+            self.output.write(message + "\n")
+        else:
+            print message
 
         self.parser.had_error = True
 
@@ -70,11 +130,16 @@ class Compiler(object):
 
     def end_compiler(self):
         self._emit_return()
+        self.chunk.max_stack_depth = self.chunk.compute_max_stack_depth()
 
         if self.DEBUG_PRINT_CODE and not self.parser.had_error:
             self.chunk.disassemble("code")
 
     def advance(self):
+        if self.tokens is not None:
+            self._advance_stream()
+            return
+
         self.parser.previous = self.parser.current
 
         while True:
@@ -83,6 +148,31 @@ class Compiler(object):
                 break
             self.error_at_current(self.parser.current.message)
 
+    def _advance_stream(self):
+        # The parser only looks at the previous and current tokens, so two
+        # Token objects are reused for the whole stream.
+        token = self.parser.previous
+        if token is None:
+            token = Token(0, 0, TokenTypes.EOF)
+        self.parser.previous = self.parser.current
+
+        while True:
+            index = self.token_index
+            self.tokens.load(index, token)
+            self.parser.current = token
+            if index < self.tokens.size() - 1:
+                # Stay on the EOF token once we reach it
+                self.token_index = index + 1
+            if token.type == TokenTypes.NUMBER:
+                token.value = self.tokens.values[self.number_index]
+                self.number_index += 1
+            elif token.type == TokenTypes.IDENTIFIER:
+                token.name = self.tokens.names[self.name_index]
+                self.name_index += 1
+            if token.type != TokenTypes.ERROR:
+                break
+            self.error_at_current(self.tokens.get_message(index))
+
     def consume(self, token_type, msg):
         if self.parser.current.type == token_type:
             self.advance()
@@ -92,32 +182,79 @@ class Compiler(object):
 
     def make_constant(self, value):
         constant = self.chunk.add_constant(value)
-        if constant > 255:
+        if constant >= Chunk.MAX_CONSTANTS:
             self.error("Too many constants in one chunk.")
             return 0
         return constant
 
     def emit_byte(self, byte):
         self.chunk.write_chunk(byte)
+        self.constant_at = -1
 
     def emit_bytes(self, byte_a, byte_b):
         self.emit_byte(byte_a)
         self.emit_byte(byte_b)
 
     def _emit_constant(self, value):
-        self.emit_bytes(OpCode.OP_CONSTANT, self.make_constant(value))
+        offset = len(self.chunk.code)
+        pool_mark = len(self.chunk.constants)
+        self.chunk.write_constant(self.make_constant(value))
+        self.constant_at = offset
+        self.constant_value = value
+        self.constant_pool_mark = pool_mark
+
+    def _trailing_constant(self):
+        """
+        Returns the offset of the OP_CONSTANT that the code emitted so far
+        ends with, or -1 if it doesn't end with one or we aren't folding.
+
+        Every operand is compiled just before its operator is emitted, so a
+        trailing OP_CONSTANT is always the whole of the latest operand.
+        """
+        if not self.FOLD_CONSTANTS or self.parser.had_error:
+            return -1
+        return self.constant_at
+
+    def _replace_with_constant(self, offset, pool_mark, value):
+        # Drop the instructions from offset onwards, they are being
+        # replaced by loading their folded result. Any constants added
+        # since pool_mark were only used by those instructions.
+        del self.chunk.code[offset:]
+        self.chunk.truncate_constants(pool_mark)
+        self._emit_constant(value)
 
     def _emit_return(self):
         self.emit_byte(OpCode.OP_RETURN)
 
     def grouping(self):
+        if self.ITERATIVE:
+            self._await_operand(Precedence.DEFAULT, GROUPING, 0)
+            return
         self.expression()
+        self._end_grouping()
+
+    def _end_grouping(self):
         self.consume(TokenTypes.RIGHT_PAREN, "Expected ')' after expression.")
 
     def unary(self):
         op_type = self.parser.previous.type
+        if self.ITERATIVE:
+            self._await_operand(Precedence.UNARY, UNARY, op_type)
+            return
         # Compile the operand
         self.parse_precedence(Precedence.UNARY)
+        self._end_unary(op_type)
+
+    def _end_unary(self, op_type):
+        operand_at = self._trailing_constant()
+        if operand_at >= 0:
+            if op_type == TokenTypes.MINUS:
+                # Exactly what OP_NEGATE does, so signed zeros match
+                self._replace_with_constant(
+                    operand_at, self.constant_pool_mark,
+                    self.constant_value * -1)
+            return
+
         # Emit the operator instruction
         if op_type == TokenTypes.MINUS:
             self.emit_byte(OpCode.OP_NEGATE)
@@ -128,15 +265,67 @@ class Compiler(object):
         # As binary ops are "infix" we've already
         # consumed the left operand.
 
+        left_at = self._trailing_constant()
+        left = self.constant_value
+        pool_mark = self.constant_pool_mark
+
         # Compile the right operand
         rule = self._get_rule(op_type)
+        if self.ITERATIVE:
+            self._await_operand(rule.precedence + 1, BINARY, op_type,
+                                left_at, left, pool_mark)
+            return
         self.parse_precedence(rule.precedence + 1)
+        self._end_binary(op_type, left_at, left, pool_mark)
+
+    def _end_binary(self, op_type, left_at, left, pool_mark):
+        if left_at >= 0 and self._trailing_constant() >= 0:
+            right = self.constant_value
+            if self._fold_binary(op_type, left_at, pool_mark, left, right):
+                return
+
+        if op_type == TokenTypes.PLUS: op = OpCode.OP_ADD
+        elif op_type == TokenTypes.MINUS: op = OpCode.OP_SUBTRACT
+        elif op_type == TokenTypes.STAR: op = OpCode.OP_MULTIPLY
+        elif op_type == TokenTypes.SLASH: op = OpCode.OP_DIVIDE
+        else: return
+
+        # The right operand is the latest constant, if it's a constant at
+        # all. Turn its OP_CONSTANT into the superinstruction, unless it
+        # needed the long form.
+        right_at = self.constant_at
+        if (self.SUPERINSTRUCTIONS and right_at >= 0 and
+                self.chunk.get_code(right_at) == OpCode.OP_CONSTANT):
+            self.chunk.code[right_at] = chr(OpCode.ConstantBinaryOps[op])
+            self.constant_at = -1
+            return
 
         # Emit the operator instruction
-        if op_type == TokenTypes.PLUS: self.emit_byte(OpCode.OP_ADD)
-        if op_type == TokenTypes.MINUS: self.emit_byte(OpCode.OP_SUBTRACT)
-        if op_type == TokenTypes.STAR: self.emit_byte(OpCode.OP_MULTIPLY)
-        if op_type == TokenTypes.SLASH: self.emit_byte(OpCode.OP_DIVIDE)
+        self.emit_byte(op)
+
+    def _fold_binary(self, op_type, offset, pool_mark, left, right):
+        """
+        Replace a binary operation on two constants with its result,
+        computed with the same float operations the VM would use.
+        Returns False if the operation has to be left for runtime.
+        """
+        if op_type == TokenTypes.PLUS:
+            result = left + right
+        elif op_type == TokenTypes.MINUS:
+            result = left - right
+        elif op_type == TokenTypes.STAR:
+            result = left * right
+        elif op_type == TokenTypes.SLASH:
+            # Leave division by zero to the VM, so the outcome (an inf or
+            # nan after translation, an error when untranslated) is the
+            # same as without folding.
+            if right == 0.0:
+                return False
+            result = left / right
+        else:
+            return False
+        self._replace_with_constant(offset, pool_mark, result)
+        return True
 
     def parse_precedence(self, precedence):
         # parses any expression of a given precedence level or higher
@@ -154,27 +343,117 @@ class Compiler(object):
             infix_method(self)
 
     def number(self):
-        value = float(self.scanner.get_token_string(self.parser.previous))
-        self._emit_constant(value)
+        self._emit_constant(self.parser.previous.value)
+
+    def variable(self):
+        name = self.parser.previous.name
+        if name not in self.variables:
+            self.error("Undefined variable.")
+            return
+        slot = self.variables[name]
+        if slot > 255:
+            self.error("Too many variables.")
+            return
+        self.emit_bytes(OpCode.OP_LOAD_VAR, slot)
+        if slot >= self.chunk.variable_count:
+            self.chunk.variable_count = slot + 1
 
     def expression(self):
-        self.parse_precedence(Precedence.DEFAULT)
+        if self.ITERATIVE:
+            self.parse_iterative()
+        else:
+            self.parse_precedence(Precedence.DEFAULT)
+
+    def parse_iterative(self):
+        """
+        Parse an expression with the same rules table, emitting the same
+        code, as parse_precedence but without recursing.
+
+        In iterative mode a rule that needs an operand pushes a PendingRule
+        with _await_operand and returns. The operand is then parsed here,
+        after which the rule is finished off. Memory use grows with the
+        nesting depth of the expression but the native stack doesn't.
+        """
+        precedence = Precedence.DEFAULT
+
+        while True:
+            # Parse an expression of `precedence` or higher
+            self.advance()
+            prefix_rule = self._get_rule(self.parser.previous.type).prefix
+            # As in parse_precedence, an operand that is missing isn't
+            # followed by any infix operators, it's given up on and the
+            # pending rule finished
+            missing = prefix_rule is None
+            if missing:
+                self.error("Expected expression.")
+            elif self._call_rule(prefix_rule, precedence):
+                precedence = self.pending[-1].operand_precedence
+                continue
+
+            while True:
+                if (not missing and precedence <=
+                        self._get_rule(self.parser.current.type).precedence):
+                    self.advance()
+                    infix_method = self._get_rule(self.parser.previous.type).infix
+                    if self._call_rule(infix_method, precedence):
+                        precedence = self.pending[-1].operand_precedence
+                        break
+                    continue
+
+                # The expression at this precedence is complete, so it is
+                # the operand the innermost pending rule was waiting for.
+                if not self.pending:
+                    return
+                rule = self.pending.pop()
+                precedence = rule.precedence
+                missing = False
+                if rule.kind == GROUPING:
+                    self._end_grouping()
+                elif rule.kind == UNARY:
+                    self._end_unary(rule.op_type)
+                else:
+                    self._end_binary(rule.op_type, rule.left_at, rule.left,
+                                     rule.pool_mark)
+
+    def _call_rule(self, rule_method, precedence):
+        """
+        Call a parse rule, returning True if it is now waiting on an
+        operand. Parsing resumes at `precedence` once it's finished.
+        """
+        waiting = len(self.pending)
+        rule_method(self)
+        if len(self.pending) > waiting:
+            self.pending[-1].precedence = precedence
+            return True
+        return False
+
+    def _await_operand(self, operand_precedence, kind, op_type,
+                       left_at=-1, left=0.0, pool_mark=0):
+        self.pending.append(PendingRule(operand_precedence, kind, op_type,
+                                        left_at, left, pool_mark))
 
     @staticmethod
     def _get_rule(op_type):
         return rules[op_type]
 
 
+# The kinds of PendingRule
+GROUPING = 0
+UNARY = 1
+BINARY = 2
+
+
 # The table that drives our whole parser. Entries per token of:
 # [ prefix, infix, precedence]
 rules = [
     ParseRule(None,                 None,               Precedence.NONE),        # ERROR
     ParseRule(None,                 None,               Precedence.NONE),        # EOF
-    ParseRule(Compiler.grouping,    None,               Precedence.CALL),        # LEFT_PAREN
+    ParseRule(Compiler.grouping,    None,               Precedence.NONE),        # LEFT_PAREN
     ParseRule(None,                 None,               Precedence.NONE),        # RIGHT_PAREN
     ParseRule(Compiler.unary,       Compiler.binary,    Precedence.TERM),        # MINUS
     ParseRule(None,                 Compiler.binary,    Precedence.TERM),        # PLUS
     ParseRule(None,                 Compiler.binary,    Precedence.FACTOR),      # SLASH
     ParseRule(None,                 Compiler.binary,    Precedence.FACTOR),      # STAR
     ParseRule(Compiler.number,      None,               Precedence.NONE),        # NUMBER
+    ParseRule(Compiler.variable,    None,               Precedence.NONE),        # IDENTIFIER
 ]
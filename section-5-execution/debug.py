@@ -35,13 +35,18 @@ def format_constant(name, chunk, constant):
 
 
 def constant_instruction(name, chunk, offset):
-    constant = chunk.code[offset + 1]
+    constant = chunk.get_code(offset + 1)
     return format_constant(name, chunk, constant), offset + 2
 
 
-def get_printable_location(ip, passed_instruction, chunk, vm):
+def constant_long_instruction(name, chunk, offset):
+    constant = chunk.read_constant_index(offset)
+    return format_constant(name, chunk, constant), offset + 4
+
+
+def get_printable_location(ip, chunk):
     instruction_index = format_ip(ip)
-    instruction = chunk.code[ip]
+    instruction = chunk.get_code(ip)
     instruction_name = format_instruction(get_instruction_name(instruction))
     _, instruction_extras = format_instruction_extended(chunk, instruction, instruction_name, ip)
     return "%s %s %s" % (instruction_index, instruction_name, instruction_extras)
@@ -50,7 +55,7 @@ def get_printable_location(ip, passed_instruction, chunk, vm):
 def disassemble_instruction(chunk, offset):
     print format_ip(offset),
 
-    instruction = chunk.code[offset]
+    instruction = chunk.get_code(offset)
     if instruction not in OpCodeToInstructionName:
         print "Unknown opcode %s" % instruction
         return offset + 1
@@ -71,6 +76,12 @@ def format_instruction_extended(chunk, instruction, instruction_name, offset):
     if instruction == OpCode.OP_CONSTANT:
         assert len(chunk.constants) > 0
         repr, ip = constant_instruction(instruction_name, chunk, offset)
+    elif instruction == OpCode.OP_CONSTANT_LONG:
+        repr, ip = constant_long_instruction(instruction_name, chunk, offset)
+    elif instruction == OpCode.OP_LOAD_VAR:
+        repr, ip = "(slot %d)" % chunk.get_code(offset + 1), offset + 2
+    elif instruction in OpCode.SuperInstructions:
+        repr, ip = constant_instruction(instruction_name, chunk, offset)
     elif instruction in OpCode.BinaryOps:
         repr, ip = binary_instruction(instruction_name, chunk, offset)
     else:
@@ -87,5 +98,5 @@ def get_instruction_name(instruction):
 
 
 def format_instruction(instruction_name):
-    return rightpad_string("%s " % instruction_name, 12)
+    return rightpad_string("%s " % instruction_name, 18)
 
@@ -0,0 +1,125 @@
+import os
+
+from rpython.rlib import rpoll
+
+READ_SIZE = 2**16
+
+# How many finished batches each worker may have waiting to be written
+# before we stop reading from it, which bounds the memory used.
+MAX_PENDING_BATCHES = 4
+
+
+class WorkerOutput(object):
+    """
+    The output a worker process sends back over its pipe: the results of
+    each batch it evaluates in turn, each batch followed by a "#<lines>"
+    line giving the number of lines it evaluated. Neither results nor
+    compile errors contain a '#'.
+    """
+
+    def __init__(self, pid, fd):
+        self.pid = pid
+        self.fd = fd
+        self.closed = False
+        # The pieces received of the batch in progress, and of its line
+        # count after the '#'
+        self.parts = []
+        self.count_parts = []
+        self.in_count = False
+        # Complete batches not yet written, oldest first
+        self.batches = []
+        self.line_counts = []
+
+    def feed(self, data):
+        # Only the new data is searched, and a batch is joined together
+        # once it's complete, however many reads it arrived in
+        pos = 0
+        while pos < len(data):
+            assert pos >= 0
+            if not self.in_count:
+                marker = data.find('#', pos)
+                if marker == -1:
+                    self._append(self.parts, data, pos, len(data))
+                    return
+                self._append(self.parts, data, pos, marker)
+                self.in_count = True
+                pos = marker + 1
+            assert pos >= 0
+            newline = data.find('\n', pos)
+            if newline == -1:
+                self._append(self.count_parts, data, pos, len(data))
+                return
+            self._append(self.count_parts, data, pos, newline)
+            self.batches.append("".join(self.parts))
+            self.line_counts.append(int("".join(self.count_parts)))
+            self.parts = []
+            self.count_parts = []
+            self.in_count = False
+            pos = newline + 1
+
+    @staticmethod
+    def _append(parts, data, start, end):
+        assert start >= 0 and end >= 0
+        if end > start:
+            parts.append(data[start:end])
+
+    def incomplete(self):
+        """
+        Whether part of a batch has been received without the rest.
+        """
+        return self.in_count or len(self.parts) > 0
+
+    def read(self):
+        data = os.read(self.fd, READ_SIZE)
+        if data:
+            self.feed(data)
+        else:
+            self.closed = True
+            os.close(self.fd)
+
+
+class ReorderBuffer(object):
+    """
+    Merges the batches from a set of workers back into input order, where
+    batch i is evaluated by worker i % len(workers).
+    """
+
+    def __init__(self, workers, output):
+        self.workers = workers
+        self.output = output
+        self.next_batch = 0
+        self.lines = 0
+
+    def run(self):
+        """
+        Read from the workers until they have all finished, writing their
+        batches to output in order. Returns False if a worker stopped
+        before sending all its output.
+        """
+        while True:
+            fds = {}
+            for worker in self.workers:
+                if (not worker.closed and
+                        len(worker.batches) < MAX_PENDING_BATCHES):
+                    fds[worker.fd] = rpoll.POLLIN
+            if not fds:
+                break
+            for fd, events in rpoll.poll(fds, -1):
+                for worker in self.workers:
+                    if worker.fd == fd and not worker.closed:
+                        worker.read()
+            self._write_ready()
+
+        for worker in self.workers:
+            if worker.batches or worker.incomplete():
+                return False
+        return True
+
+    def _write_ready(self):
+        while True:
+            worker = self.workers[self.next_batch % len(self.workers)]
+            if not worker.batches:
+                return
+            self.output.write(worker.batches.pop(0))
+            self.lines += worker.line_counts.pop(0)
+            self.next_batch += 1
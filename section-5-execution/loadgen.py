@@ -0,0 +1,87 @@
+"""
+Load generator for calc --serve.
+
+    python loadgen.py SOCKET [--clients N] [--requests N] [--expression E]
+
+Each client connects to the server and sends its requests one after
+another, waiting for each response. Reports the requests per second over
+all clients and the median and 99th percentile latency.
+"""
+import argparse
+import socket
+import struct
+import threading
+import time
+
+
+def receive_exactly(sock, count):
+    data = b""
+    while len(data) < count:
+        piece = sock.recv(count - len(data))
+        if not piece:
+            raise IOError("server closed the connection")
+        data += piece
+    return data
+
+
+def request(sock, source):
+    sock.sendall(struct.pack(">I", len(source)) + source)
+    length, = struct.unpack(">I", receive_exactly(sock, 4))
+    return receive_exactly(sock, length)
+
+
+def client(path, source, count, latencies, errors):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.connect(path)
+    try:
+        for _ in range(count):
+            start = time.time()
+            response = request(sock, source)
+            latencies.append(time.time() - start)
+            if not response.startswith(b"="):
+                errors.append(response)
+    finally:
+        sock.close()
+
+
+def percentile(ordered, fraction):
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("socket")
+    parser.add_argument("--clients", type=int, default=16)
+    parser.add_argument("--requests", type=int, default=10000,
+                        help="requests per client")
+    parser.add_argument("--expression",
+                        default="(1 + 2) * 3 - 4 / (5 + 6 * 7)")
+    args = parser.parse_args()
+
+    source = args.expression.encode("ascii")
+    latencies = []
+    errors = []
+    threads = [threading.Thread(target=client,
+                                args=(args.socket, source, args.requests,
+                                      latencies, errors))
+               for _ in range(args.clients)]
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - start
+
+    latencies.sort()
+    print("%d clients, %d requests in %.3f s: %.0f req/s" % (
+        args.clients, len(latencies), elapsed, len(latencies) / elapsed))
+    if latencies:
+        print("latency p50 %.1f us, p99 %.1f us" % (
+            percentile(latencies, 0.5) * 1e6,
+            percentile(latencies, 0.99) * 1e6))
+    if errors:
+        print("%d errors, first: %r" % (len(errors), errors[0]))
+
+
+if __name__ == "__main__":
+    main()
@@ -11,10 +11,116 @@ class OpCode:
     OP_SUBTRACT = 4
     OP_MULTIPLY = 5
     OP_DIVIDE = 6
+    # Like OP_CONSTANT but with a three byte, little endian, operand.
+    # Emitted once a chunk has more than 256 constants.
+    OP_CONSTANT_LONG = 7
+    # Superinstructions, each an OP_CONSTANT followed by a binary op. The
+    # operand is the index of the right hand constant.
+    OP_ADD_CONST = 8
+    OP_SUBTRACT_CONST = 9
+    OP_MULTIPLY_CONST = 10
+    OP_DIVIDE_CONST = 11
+    # Push the value of a variable, the operand is its slot
+    OP_LOAD_VAR = 12
 
     BinaryOps = {
         OP_ADD: "+",
         OP_SUBTRACT: "-",
         OP_MULTIPLY: "*",
         OP_DIVIDE: "/"
-    }
\ No newline at end of file
+    }
+
+    # The binary op each superinstruction does after loading its constant
+    SuperInstructions = {
+        OP_ADD_CONST: OP_ADD,
+        OP_SUBTRACT_CONST: OP_SUBTRACT,
+        OP_MULTIPLY_CONST: OP_MULTIPLY,
+        OP_DIVIDE_CONST: OP_DIVIDE,
+    }
+
+    # The superinstruction for each binary op with a constant right operand
+    ConstantBinaryOps = {op: fused for fused, op in SuperInstructions.items()}
+
+    # The number of values each instruction pushes onto the stack, less
+    # the number it pops off
+    StackEffects = {
+        OP_CONSTANT: 1,
+        OP_CONSTANT_LONG: 1,
+        OP_RETURN: -1,
+        OP_NEGATE: 0,
+        OP_ADD: -1,
+        OP_SUBTRACT: -1,
+        OP_MULTIPLY: -1,
+        OP_DIVIDE: -1,
+        OP_ADD_CONST: 0,
+        OP_SUBTRACT_CONST: 0,
+        OP_MULTIPLY_CONST: 0,
+        OP_DIVIDE_CONST: 0,
+        OP_LOAD_VAR: 1,
+    }
+
+    # The number of operand bytes following an opcode, if it has any
+    OperandBytes = {
+        OP_CONSTANT: 1,
+        OP_CONSTANT_LONG: 3,
+        OP_ADD_CONST: 1,
+        OP_SUBTRACT_CONST: 1,
+        OP_MULTIPLY_CONST: 1,
+        OP_DIVIDE_CONST: 1,
+        OP_LOAD_VAR: 1,
+    }
+
+
+class RegisterOpCode:
+    """
+    The OpCodes of the RegisterVM. Each names its operands: dst, a and b
+    are one byte register numbers and k is a constant index, one byte
+    except in OP_LOAD_LONG. A slot is a variable's slot, as in the stack
+    VM.
+    """
+
+    OP_LOAD = 0            # dst k
+    OP_LOAD_LONG = 1       # dst k k k
+    OP_RETURN = 2          # a
+    OP_NEGATE = 3          # dst a
+    OP_ADD = 4             # dst a b
+    OP_SUBTRACT = 5        # dst a b
+    OP_MULTIPLY = 6        # dst a b
+    OP_DIVIDE = 7          # dst a b
+    OP_ADD_K = 8           # dst a k
+    OP_SUBTRACT_K = 9      # dst a k
+    OP_MULTIPLY_K = 10     # dst a k
+    OP_DIVIDE_K = 11       # dst a k
+    OP_LOAD_VAR = 12       # dst slot
+
+    # The register instruction for each stack VM binary op, on two
+    # registers and on a register and a constant
+    BinaryOps = {
+        OpCode.OP_ADD: OP_ADD,
+        OpCode.OP_SUBTRACT: OP_SUBTRACT,
+        OpCode.OP_MULTIPLY: OP_MULTIPLY,
+        OpCode.OP_DIVIDE: OP_DIVIDE,
+    }
+    ConstantBinaryOps = {
+        OpCode.OP_ADD: OP_ADD_K,
+        OpCode.OP_SUBTRACT: OP_SUBTRACT_K,
+        OpCode.OP_MULTIPLY: OP_MULTIPLY_K,
+        OpCode.OP_DIVIDE: OP_DIVIDE_K,
+    }
+
+    # The number of operand bytes following each opcode
+    OperandBytes = {
+        OP_LOAD: 2,
+        OP_LOAD_LONG: 4,
+        OP_RETURN: 1,
+        OP_NEGATE: 2,
+        OP_ADD: 3,
+        OP_SUBTRACT: 3,
+        OP_MULTIPLY: 3,
+        OP_DIVIDE: 3,
+        OP_ADD_K: 3,
+        OP_SUBTRACT_K: 3,
+        OP_MULTIPLY_K: 3,
+        OP_DIVIDE_K: 3,
+        OP_LOAD_VAR: 2,
+    }
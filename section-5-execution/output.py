@@ -0,0 +1,142 @@
+import math
+
+from rpython.rlib.rfloat import DTSF_ADD_DOT_0, formatd
+from rpython.rlib.rstring import StringBuilder
+from scanner import POWERS_OF_TEN
+
+BUFFER_SIZE = 2**20
+
+# Every integer below this is exact as a float
+MAX_EXACT_INTEGER = 2.0 ** 53
+
+
+def format_float(value):
+    """
+    The shortest string that reads back as exactly value, the same as
+    Python's repr: 3.0, 0.1, 1e+16, -0.0, inf, nan.
+    """
+    magnitude = math.fabs(value)
+    if 1e-4 <= magnitude < MAX_EXACT_INTEGER:
+        # Search for the fewest fraction digits that read back as value.
+        # If some number of digits does then any more do too, so this is
+        # a binary search.
+        digits = -1
+        found = 0
+        mantissa = 0.0
+        low = 0
+        high = len(POWERS_OF_TEN) - 1
+        while low <= high:
+            middle = (low + high) // 2
+            middle_found, middle_mantissa = _read_back(magnitude, middle)
+            if middle_found > 0:
+                digits = middle
+                found = middle_found
+                mantissa = middle_mantissa
+                high = middle - 1
+            elif middle_found < 0:
+                high = middle - 1
+            else:
+                low = middle + 1
+        # If more than one mantissa reads back, leave picking the nearest
+        # to dtoa.
+        if found == 1:
+            return _format_fixed(value < 0.0, int(mantissa), digits)
+    return formatd(value, 'r', 0, DTSF_ADD_DOT_0)
+
+
+def _read_back(magnitude, digits):
+    """
+    Count the mantissas near magnitude * 10**digits that read back as
+    magnitude, returning the count, or -1 if they are too big to tell,
+    and the last that does. While the mantissa is below MAX_EXACT_INTEGER,
+    reading back is a single correctly rounded division, as in
+    Scanner._number.
+    """
+    scale = POWERS_OF_TEN[digits]
+    mantissa = math.floor(magnitude * scale + 0.5)
+    if mantissa + 1.0 >= MAX_EXACT_INTEGER:
+        return -1, 0.0
+    # The rounding of magnitude * scale can be off by one from the
+    # nearest mantissa, so try its neighbours too.
+    found = 0
+    reads_back = mantissa
+    if mantissa / scale == magnitude:
+        found += 1
+    if (mantissa - 1.0) / scale == magnitude:
+        found += 1
+        reads_back = mantissa - 1.0
+    if (mantissa + 1.0) / scale == magnitude:
+        found += 1
+        reads_back = mantissa + 1.0
+    return found, reads_back
+
+
+def _format_fixed(negative, mantissa, digits):
+    """
+    Format mantissa / 10**digits.
+    """
+    sign = "-" if negative else ""
+    if digits == 0:
+        return "%s%d.0" % (sign, mantissa)
+    text = "%d" % mantissa
+    if len(text) <= digits:
+        text = "0" * (digits + 1 - len(text)) + text
+    point = len(text) - digits
+    assert point > 0
+    return "%s%s.%s" % (sign, text[:point], text[point:])
+
+
+class OutputBuffer(object):
+    """
+    Collects output and writes it to a file in blocks of about `size`
+    bytes, rather than a write per line.
+    """
+
+    def __init__(self, file, size=BUFFER_SIZE, line_buffered=False):
+        self.file = file
+        self.size = size
+        # Flush at the end of every line, for interactive output
+        self.line_buffered = line_buffered
+        self.builder = StringBuilder(size)
+        self.length = 0
+
+    def write(self, text):
+        self.builder.append(text)
+        self.length += len(text)
+        if self.length >= self.size or (
+                self.line_buffered and text.endswith("\n")):
+            self.flush()
+
+    def flush(self):
+        if self.length > 0:
+            self.file.write(self.builder.build())
+            self.builder = StringBuilder(self.size)
+            self.length = 0
+        self.file.flush()
+
+
+class ResultSink(object):
+    """
+    Where the VM sends the result of each chunk it runs, formatted one per
+    line into an OutputBuffer.
+    """
+
+    def __init__(self, output):
+        self.output = output
+
+    def write_result(self, value):
+        self.output.write(format_float(value))
+        self.output.write("\n")
+
+
+class LastResult(ResultSink):
+    """
+    A sink that keeps the last result rather than writing it out.
+    """
+
+    def __init__(self):
+        ResultSink.__init__(self, None)
+        self.value = 0.0
+
+    def write_result(self, value):
+        self.value = value
@@ -0,0 +1,45 @@
+from debug import (OpCodeToInstructionName, format_instruction,
+                   get_instruction_name, leftpad_string)
+
+OPCODE_COUNT = max(OpCodeToInstructionName) + 1
+
+
+class OpcodePairs(object):
+    """
+    A histogram of the pairs of instructions the VM executes one after the
+    other, for finding the sequences worth fusing into superinstructions.
+    """
+
+    def __init__(self):
+        self.counts = [0] * (OPCODE_COUNT * OPCODE_COUNT)
+        self.total = 0
+
+    def record(self, first, second):
+        self.counts[first * OPCODE_COUNT + second] += 1
+        self.total += 1
+
+    def report(self, limit=20):
+        """
+        The `limit` most frequent pairs, one per line, most frequent first.
+        """
+        pairs = [i for i in range(len(self.counts)) if self.counts[i] > 0]
+        # Insertion sort by descending count, there are few pairs
+        for i in range(1, len(pairs)):
+            pair = pairs[i]
+            j = i
+            while j > 0 and self.counts[pairs[j - 1]] < self.counts[pair]:
+                pairs[j] = pairs[j - 1]
+                j -= 1
+            pairs[j] = pair
+
+        lines = ["opcode pairs: %d executed" % self.total]
+        for pair in pairs[:limit]:
+            first = get_instruction_name(pair // OPCODE_COUNT)
+            second = get_instruction_name(pair % OPCODE_COUNT)
+            count = self.counts[pair]
+            tenths = int(1000.0 * count / self.total + 0.5)
+            lines.append("%s%s%s %s%%" % (
+                format_instruction(first), format_instruction(second),
+                leftpad_string("%d" % count, 10),
+                leftpad_string("%d.%d" % (tenths // 10, tenths % 10), 5)))
+        return "\n".join(lines)
@@ -0,0 +1,136 @@
+import math
+
+from opcodes import OpCode
+
+
+class Instructions(object):
+    """
+    A chunk's code decoded into parallel lists of opcodes and operands,
+    where constant operands are values rather than pool indices.
+    """
+
+    def __init__(self):
+        self.ops = []
+        self.values = []
+
+    def append(self, op, value):
+        self.ops.append(op)
+        self.values.append(value)
+
+    def pop(self):
+        self.ops.pop()
+        self.values.pop()
+
+    def ends_with(self, op_a, op_b):
+        n = len(self.ops)
+        return n >= 2 and self.ops[n - 2] == op_a and self.ops[n - 1] == op_b
+
+    def second_to_last_value(self):
+        return self.values[len(self.values) - 2]
+
+
+def _is_identity_operand(op, value):
+    """
+    Is `x op value` exactly x for every float x, including signed zeros,
+    infinities and nans?  Note that x + 0.0 is not, as -0.0 + 0.0 == 0.0.
+    """
+    if op == OpCode.OP_MULTIPLY or op == OpCode.OP_DIVIDE:
+        return value == 1.0
+    if op == OpCode.OP_ADD:
+        return value == 0.0 and _is_negative_zero(value)
+    if op == OpCode.OP_SUBTRACT:
+        return value == 0.0 and not _is_negative_zero(value)
+    return False
+
+
+def _is_negative_zero(value):
+    return math.copysign(1.0, value) < 0.0
+
+
+def _peephole(instructions, op):
+    """
+    Rewrite the tail of `instructions` now that `op` has been appended.
+    """
+    if instructions.ends_with(OpCode.OP_CONSTANT, OpCode.OP_NEGATE):
+        # Negate the constant, with the same operation as OP_NEGATE
+        instructions.pop()
+        value = instructions.values.pop() * -1
+        instructions.values.append(value)
+    elif instructions.ends_with(OpCode.OP_NEGATE, OpCode.OP_NEGATE):
+        instructions.pop()
+        instructions.pop()
+    elif (op in OpCode.BinaryOps and
+          instructions.ends_with(OpCode.OP_CONSTANT, op) and
+          _is_identity_operand(op, instructions.second_to_last_value())):
+        instructions.pop()
+        instructions.pop()
+
+
+def optimize_chunk(chunk, superinstructions=False):
+    """
+    Run the peephole optimizer over a compiled chunk, rewriting its code
+    and constant pool in place. Constants no longer referenced are dropped
+    from the pool. With superinstructions, a binary op with a constant
+    right operand is rewritten as the OP_*_CONST superinstruction.
+
+    Returns the number of instructions removed, counting superinstructions
+    as the two they stand for.
+    """
+    instructions = Instructions()
+    count = 0
+
+    i = 0
+    while i < len(chunk.code):
+        op = chunk.get_code(i)
+        if op == OpCode.OP_LOAD_VAR:
+            # Kept with its slot as the value
+            count += 1
+            instructions.append(op, float(chunk.get_code(i + 1)))
+            _peephole(instructions, op)
+            i += 2
+            continue
+        if op in OpCode.OperandBytes:
+            # Both constant forms and the superinstructions are decoded as
+            # an OP_CONSTANT, followed by the binary op for the latter. The
+            # encoding is chosen again when the chunk is rewritten.
+            index = chunk.read_constant_index(i)
+            count += 1
+            instructions.append(OpCode.OP_CONSTANT, chunk.constants[index])
+            _peephole(instructions, OpCode.OP_CONSTANT)
+            i += 1 + OpCode.OperandBytes[op]
+            if op in OpCode.SuperInstructions:
+                op = OpCode.SuperInstructions[op]
+            else:
+                continue
+        else:
+            i += 1
+        count += 1
+        instructions.append(op, 0.0)
+        _peephole(instructions, op)
+
+    chunk.truncate_constants(0)
+    del chunk.code[:]
+    j = 0
+    while j < len(instructions.ops):
+        op = instructions.ops[j]
+        if op == OpCode.OP_CONSTANT:
+            index = chunk.add_constant(instructions.values[j])
+            next_op = -1
+            if j + 1 < len(instructions.ops):
+                next_op = instructions.ops[j + 1]
+            if (superinstructions and index < 256 and
+                    next_op in OpCode.ConstantBinaryOps):
+                chunk.write_chunk(OpCode.ConstantBinaryOps[next_op])
+                chunk.write_chunk(index)
+                j += 1
+            else:
+                chunk.write_constant(index)
+        elif op == OpCode.OP_LOAD_VAR:
+            chunk.write_chunk(op)
+            chunk.write_chunk(int(instructions.values[j]))
+        else:
+            chunk.write_chunk(op)
+        j += 1
+    chunk.max_stack_depth = chunk.compute_max_stack_depth()
+
+    return count - len(instructions.ops)
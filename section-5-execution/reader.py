@@ -0,0 +1,112 @@
+import os
+
+from rpython.rlib import rmmap
+
+BLOCK_SIZE = 2**16
+
+
+class LineReader(object):
+    """
+    Reads a file in blocks of `block_size` bytes and hands out its lines in
+    pieces no longer than a block, so a line of any length can be read in
+    bounded memory.
+    """
+
+    def __init__(self, file, block_size=BLOCK_SIZE):
+        self.file = file
+        self.block_size = block_size
+        self.block = ""
+        self.pos = 0
+        self.eof = False
+
+    def _fill_block(self):
+        """
+        Make sure the block has unread data, returning False at the end of
+        the file.
+        """
+        if self.pos < len(self.block):
+            return True
+        if self.eof:
+            return False
+        # readline rather than read, so an interactive line is handed out
+        # as soon as it's entered
+        self.block = self.file.readline(self.block_size)
+        self.pos = 0
+        if not self.block:
+            self.eof = True
+            return False
+        return True
+
+    def read_piece(self):
+        """
+        Return the next piece of the current line, without its newline, or
+        "" once the line has ended. The newline is left unread, so every
+        call after that returns "" until next_line().
+        """
+        if not self._fill_block():
+            return ""
+        pos = self.pos
+        assert pos >= 0
+        newline = self.block.find('\n', pos)
+        if newline == -1:
+            newline = len(self.block)
+        assert newline >= 0
+        self.pos = newline
+        return self.block[pos:newline]
+
+    def at_line_end(self):
+        """
+        Has all of the current line been read?
+        """
+        return not self._fill_block() or self.block[self.pos] == '\n'
+
+    def next_line(self):
+        """
+        Skip the rest of the current line, including its newline.
+        """
+        while self.read_piece():
+            pass
+        if self._fill_block():
+            self.pos += 1
+
+
+class MappedFile(object):
+    """
+    A file mapped read-only into memory, read a window of whole lines at a
+    time. Raises OSError if the file can't be opened, and RMMapError if it
+    can't be mapped.
+    """
+
+    def __init__(self, path):
+        self.fd = os.open(path, os.O_RDONLY, 0)
+        self.size = os.fstat(self.fd).st_size
+        self.mapping = None
+        if self.size > 0:
+            try:
+                self.mapping = rmmap.mmap(self.fd, self.size,
+                                          access=rmmap.ACCESS_READ)
+            except rmmap.RMMapError:
+                os.close(self.fd)
+                raise
+
+    def window_end(self, pos, window_size):
+        """
+        Where the window starting at pos ends: after the last newline
+        within window_size bytes, or further for lines longer than that.
+        """
+        while True:
+            end = min(pos + window_size, self.size)
+            if end == self.size:
+                return end
+            newline = self.mapping.find("\n", pos, end, reverse=True)
+            if newline != -1:
+                return newline + 1
+            window_size *= 2
+
+    def window(self, pos, end):
+        return self.mapping.getslice(pos, end - pos)
+
+    def close(self):
+        if self.mapping is not None:
+            self.mapping.close()
+        os.close(self.fd)
@@ -0,0 +1,243 @@
+"""
+A register machine backend. Chunks compiled for the stack VM are
+translated into three address code, such as OP_ADD r1 r0 r1, which the
+RegisterVM runs. Both backends share the scanner, the parser and every
+optimization of the stack code.
+"""
+from debug import format_ip, format_instruction, leftpad_string
+from opcodes import OpCode, RegisterOpCode
+from rpython.rlib.debug import make_sure_not_resized
+
+# Register operands are a single byte
+MAX_REGISTERS = 256
+
+RegisterOpCodeToName = {getattr(RegisterOpCode, op): op
+                        for op in dir(RegisterOpCode) if op.startswith('OP_')}
+
+# The instructions whose last operand is a constant
+_CONSTANT_OPS = {op: None
+                 for op in RegisterOpCode.ConstantBinaryOps.values()}
+
+
+class RegisterChunk(object):
+    def __init__(self, constants):
+        # The code is bytes, as in Chunk. The constants are shared with
+        # the stack chunk the code was translated from.
+        self.code = []
+        self.constants = constants
+        self.register_count = 0
+        self.instruction_count = 0
+
+    def write_instruction(self, op, operands):
+        self.code.append(chr(op))
+        for operand in operands:
+            self.code.append(chr(operand))
+        self.instruction_count += 1
+
+    def get_code(self, offset):
+        return ord(self.code[offset])
+
+    def disassemble(self, name):
+        print "== %s ==\n" % name
+        offset = 0
+        while offset < len(self.code):
+            op = self.get_code(offset)
+            operand_count = RegisterOpCode.OperandBytes[op]
+            operands = []
+            # The index of the constant operand, if there is one
+            index = -1
+            if op == RegisterOpCode.OP_LOAD_LONG:
+                operands.append("r%d" % self.get_code(offset + 1))
+                index = (self.get_code(offset + 2) |
+                         (self.get_code(offset + 3) << 8) |
+                         (self.get_code(offset + 4) << 16))
+            else:
+                for i in range(1, operand_count + 1):
+                    operands.append("r%d" % self.get_code(offset + i))
+                if op == RegisterOpCode.OP_LOAD_VAR:
+                    operands[1] = "v%d" % self.get_code(offset + 2)
+                if op == RegisterOpCode.OP_LOAD or op in _CONSTANT_OPS:
+                    operands.pop()
+                    index = self.get_code(offset + operand_count)
+            line = "%s %s%s" % (format_ip(offset),
+                                format_instruction(RegisterOpCodeToName[op]),
+                                " ".join(operands))
+            if index >= 0:
+                line += " k%d %s" % (index, leftpad_string(
+                    "'%s'" % ("%f" % self.constants[index])[:16], 10))
+            print line
+            offset += 1 + operand_count
+
+
+class RegisterCompiler(object):
+    """
+    Translates a stack chunk to register code. The value in stack slot i
+    is kept in register i, so each subexpression's result gets the
+    register of the slot it would have been pushed to. Constants aren't
+    loaded into a register until they have to be: a constant right
+    operand is used directly by an OP_*_K instruction.
+    """
+
+    def __init__(self, chunk):
+        self.chunk = chunk
+        self.code = RegisterChunk(chunk.constants)
+        # The stack slots of the stack code. Each holds -1 if its value is
+        # in its register, otherwise the index of the constant it holds.
+        self.slots = []
+        self.stack_instructions = 0
+
+    def compile(self):
+        """
+        Returns the register code, or None if it needs more registers
+        than there are.
+        """
+        chunk = self.chunk
+        offset = 0
+        while True:
+            op = chunk.get_code(offset)
+            self.stack_instructions += 1
+            if op == OpCode.OP_CONSTANT or op == OpCode.OP_CONSTANT_LONG:
+                self.slots.append(chunk.read_constant_index(offset))
+            elif op == OpCode.OP_LOAD_VAR:
+                self.slots.append(-1)
+                self._emit(RegisterOpCode.OP_LOAD_VAR,
+                           [self._top(), chunk.get_code(offset + 1)])
+            elif op == OpCode.OP_NEGATE:
+                slot = self._top()
+                self._emit(RegisterOpCode.OP_NEGATE,
+                           [slot, self._in_register(slot)])
+            elif op in OpCode.BinaryOps:
+                right = self.slots.pop()
+                slot = self._top()
+                left = self._in_register(slot)
+                if right >= 0 and right < 256:
+                    self._emit(RegisterOpCode.ConstantBinaryOps[op],
+                               [slot, left, right])
+                else:
+                    self.slots.append(right)
+                    right_register = self._in_register(slot + 1)
+                    self.slots.pop()
+                    self._emit(RegisterOpCode.BinaryOps[op],
+                               [slot, left, right_register])
+            elif op in OpCode.SuperInstructions:
+                slot = self._top()
+                binary_op = OpCode.SuperInstructions[op]
+                self._emit(RegisterOpCode.ConstantBinaryOps[binary_op],
+                           [slot, self._in_register(slot),
+                            chunk.read_constant_index(offset)])
+            elif op == OpCode.OP_RETURN:
+                slot = self._top()
+                self._emit(RegisterOpCode.OP_RETURN,
+                           [self._in_register(slot)])
+                break
+            offset += 1 + OpCode.OperandBytes.get(op, 0)
+
+        if self.code.register_count > MAX_REGISTERS:
+            return None
+        return self.code
+
+    def _top(self):
+        return len(self.slots) - 1
+
+    def _in_register(self, slot):
+        """
+        The register holding the value in slot, loading it first if it's
+        a constant.
+        """
+        constant = self.slots[slot]
+        if constant >= 0:
+            if constant < 256:
+                self._emit(RegisterOpCode.OP_LOAD, [slot, constant])
+            else:
+                self._emit(RegisterOpCode.OP_LOAD_LONG,
+                           [slot, constant & 0xff, (constant >> 8) & 0xff,
+                            (constant >> 16) & 0xff])
+            self.slots[slot] = -1
+        return slot
+
+    def _emit(self, op, operands):
+        # Registers past the last one are never run, they only make the
+        # chunk too big
+        if operands[0] + 1 > self.code.register_count:
+            self.code.register_count = operands[0] + 1
+        if self.code.register_count <= MAX_REGISTERS:
+            self.code.write_instruction(op, operands)
+
+    def report(self):
+        """
+        Compares the size of the stack and register code.
+        """
+        return ("stack code: %d instructions, %d bytes\n"
+                "register code: %d instructions, %d bytes, %d registers" % (
+                    self.stack_instructions, len(self.chunk.code),
+                    self.code.instruction_count, len(self.code.code),
+                    self.code.register_count))
+
+
+class RegisterVM(object):
+    def __init__(self):
+        self.registers = [0.0] * MAX_REGISTERS
+        make_sure_not_resized(self.registers)
+
+    def run(self, chunk, variables):
+        """
+        Run register code with variables, by slot, returning the value of
+        its OP_RETURN.
+        """
+        code = chunk.code
+        constants = chunk.constants
+        registers = self.registers
+        ip = 0
+        while True:
+            op = ord(code[ip])
+            dst = ord(code[ip + 1])
+            # RPython turns this chain of comparisons into a C switch
+            if op == RegisterOpCode.OP_LOAD:
+                registers[dst] = constants[ord(code[ip + 2])]
+                ip += 3
+            elif op == RegisterOpCode.OP_LOAD_LONG:
+                registers[dst] = constants[ord(code[ip + 2]) |
+                                           (ord(code[ip + 3]) << 8) |
+                                           (ord(code[ip + 4]) << 16)]
+                ip += 5
+            elif op == RegisterOpCode.OP_LOAD_VAR:
+                registers[dst] = variables[ord(code[ip + 2])]
+                ip += 3
+            elif op == RegisterOpCode.OP_NEGATE:
+                registers[dst] = registers[ord(code[ip + 2])] * -1
+                ip += 3
+            elif op == RegisterOpCode.OP_ADD:
+                registers[dst] = (registers[ord(code[ip + 2])] +
+                                  registers[ord(code[ip + 3])])
+                ip += 4
+            elif op == RegisterOpCode.OP_SUBTRACT:
+                registers[dst] = (registers[ord(code[ip + 2])] -
+                                  registers[ord(code[ip + 3])])
+                ip += 4
+            elif op == RegisterOpCode.OP_MULTIPLY:
+                registers[dst] = (registers[ord(code[ip + 2])] *
+                                  registers[ord(code[ip + 3])])
+                ip += 4
+            elif op == RegisterOpCode.OP_DIVIDE:
+                registers[dst] = (registers[ord(code[ip + 2])] /
+                                  registers[ord(code[ip + 3])])
+                ip += 4
+            elif op == RegisterOpCode.OP_ADD_K:
+                registers[dst] = (registers[ord(code[ip + 2])] +
+                                  constants[ord(code[ip + 3])])
+                ip += 4
+            elif op == RegisterOpCode.OP_SUBTRACT_K:
+                registers[dst] = (registers[ord(code[ip + 2])] -
+                                  constants[ord(code[ip + 3])])
+                ip += 4
+            elif op == RegisterOpCode.OP_MULTIPLY_K:
+                registers[dst] = (registers[ord(code[ip + 2])] *
+                                  constants[ord(code[ip + 3])])
+                ip += 4
+            elif op == RegisterOpCode.OP_DIVIDE_K:
+                registers[dst] = (registers[ord(code[ip + 2])] /
+                                  constants[ord(code[ip + 3])])
+                ip += 4
+            else:
+                # OP_RETURN, whose only operand is the register to return
+                return registers[dst]
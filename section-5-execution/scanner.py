@@ -1,3 +1,4 @@
+from rpython.rlib.objectmodel import newlist_hint
 
 
 class TokenTypes:
@@ -10,22 +11,64 @@ class TokenTypes:
     SLASH = 6
     STAR = 7
     NUMBER = 8
+    IDENTIFIER = 9
 
 
 TokenTypeToName = {getattr(TokenTypes, op): op
                    for op in dir(TokenTypes) if not op.startswith('_')}
 
 
+# The class of a character that is skipped between tokens
+WHITESPACE = -1
+
+
+def _build_char_classes():
+    """
+    The class of every character, by ord: WHITESPACE, or the type of the
+    token that the character starts, with ERROR for unexpected characters.
+    """
+    classes = [TokenTypes.ERROR] * 256
+    for char in ' \r\t\n':
+        classes[ord(char)] = WHITESPACE
+    for char in '0123456789':
+        classes[ord(char)] = TokenTypes.NUMBER
+    for char in 'abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ_':
+        classes[ord(char)] = TokenTypes.IDENTIFIER
+    classes[ord('(')] = TokenTypes.LEFT_PAREN
+    classes[ord(')')] = TokenTypes.RIGHT_PAREN
+    classes[ord('-')] = TokenTypes.MINUS
+    classes[ord('+')] = TokenTypes.PLUS
+    classes[ord('/')] = TokenTypes.SLASH
+    classes[ord('*')] = TokenTypes.STAR
+    return classes
+
+
+CHAR_CLASSES = _build_char_classes()
+
+# Every power of ten up to 1e22 is exact as a float, as is every integer
+# below 2**53, so their quotient is correctly rounded by float division.
+POWERS_OF_TEN = [float(10 ** i) for i in range(23)]
+MAX_EXACT_MANTISSA = 2 ** 53
+
+
+def char_class(char):
+    return CHAR_CLASSES[ord(char)]
+
+
 class BaseToken(object):
     pass
 
 
 class Token(BaseToken):
 
-    def __init__(self, start, length, token_type):
+    def __init__(self, start, length, token_type, value=0.0, name=""):
         self.type = token_type
         self.start = start
         self.length = length
+        # The value of a NUMBER token
+        self.value = value
+        # The name of an IDENTIFIER token
+        self.name = name
 
 
 class ErrorToken(BaseToken):
@@ -37,61 +80,181 @@ class ErrorToken(BaseToken):
         self.type = TokenTypes.ERROR
         self.message = message
         self.location = location
+        # Where errors are reported
+        self.start = location
+        self.length = 0
+        self.value = 0.0
+        self.name = ""
+
+
+class TokenStream(object):
+    """
+    All the tokens of a source held in parallel arrays of their type,
+    start and length, rather than as one object per token.
+    """
+
+    def __init__(self, size_hint=0):
+        self.types = newlist_hint(size_hint)
+        self.starts = newlist_hint(size_hint)
+        self.lengths = newlist_hint(size_hint)
+        # The values of the NUMBER tokens, in order
+        self.values = newlist_hint(size_hint // 2)
+        # The names of the IDENTIFIER tokens, in order
+        self.names = []
+        # The messages of any ERROR tokens, by token index
+        self.messages = {}
+
+    def append(self, token_type, start, length):
+        self.types.append(token_type)
+        self.starts.append(start)
+        self.lengths.append(length)
+
+    def append_number(self, start, length, value):
+        self.append(TokenTypes.NUMBER, start, length)
+        self.values.append(value)
+
+    def append_identifier(self, start, length, name):
+        self.append(TokenTypes.IDENTIFIER, start, length)
+        self.names.append(name)
+
+    def append_error(self, message, location):
+        self.messages[len(self.types)] = message
+        self.append(TokenTypes.ERROR, location, 0)
+
+    def size(self):
+        return len(self.types)
+
+    def load(self, index, token):
+        """
+        Copy the token at `index` into an existing Token object, except for
+        the value of a NUMBER token, which is kept in `values`, and the name
+        of an IDENTIFIER, kept in `names`.
+        """
+        token.type = self.types[index]
+        token.start = self.starts[index]
+        token.length = self.lengths[index]
+
+    def get_message(self, index):
+        return self.messages[index]
 
 
 class Scanner(object):
 
-    def __init__(self, source):
+    def __init__(self, source, start=0, end=-1):
+        """
+        Scan source, or just source[start:end] without copying it out.
+        """
+        if end < 0:
+            end = len(source)
         self.source = source
-        self.start = 0
-        self.current = 0
+        self.end = end
+        # The position in the input of self.source[0]: negative when only
+        # part of the source is scanned, and past the start of the input
+        # once a StreamScanner has dropped what it no longer needs.
+        self.offset = -start
+        self.start = start
+        self.current = start
+        self.error_message = ""
+        # The value of the last NUMBER token scanned
+        self.number_value = 0.0
+        # The name of the last IDENTIFIER token scanned
+        self.identifier = ""
 
     def scan_token(self):
         """Return a token"""
+        token_type = self._scan()
+        if token_type == TokenTypes.ERROR:
+            return ErrorToken(self.error_message,
+                              self.offset + self.current)
+        return self._make_token(token_type)
+
+    def scan_all(self):
+        """
+        Scan the whole source into a TokenStream, ending with the EOF token.
+        """
+        # Most tokens are at least two characters apart once whitespace
+        # is counted, so this usually avoids resizing the arrays.
+        tokens = TokenStream((self.end - self.current) // 2 + 1)
+        while True:
+            token_type = self._scan()
+            start = self.offset + self.start
+            if token_type == TokenTypes.ERROR:
+                tokens.append_error(self.error_message,
+                                    self.offset + self.current)
+            elif token_type == TokenTypes.NUMBER:
+                tokens.append_number(start, self.current - self.start,
+                                     self.number_value)
+            elif token_type == TokenTypes.IDENTIFIER:
+                tokens.append_identifier(start, self.current - self.start,
+                                         self.identifier)
+            else:
+                tokens.append(token_type, start, self.current - self.start)
+            if token_type == TokenTypes.EOF:
+                return tokens
+
+    def _scan(self):
+        """
+        Scan the next token, returning its type. The token spans from
+        self.start to self.current.
+        """
         self._skip_whitespace()
         self.start = self.current
 
         if self._is_at_end():
-            return self._make_token(TokenTypes.EOF)
-
-        char = self.advance()
+            return TokenTypes.EOF
 
-        if char.isdigit():
+        token_type = char_class(self.advance())
+        if token_type == TokenTypes.NUMBER:
             return self._number()
-
-        if char == '(':
-            return self._make_token(TokenTypes.LEFT_PAREN)
-        if char == ')':
-            return self._make_token(TokenTypes.RIGHT_PAREN)
-        if char == '-':
-            return self._make_token(TokenTypes.MINUS)
-        if char == '+':
-            return self._make_token(TokenTypes.PLUS)
-        if char == '/':
-            return self._make_token(TokenTypes.SLASH)
-        if char == '*':
-            return self._make_token(TokenTypes.STAR)
-
-        return ErrorToken("Unexpected character", self.current)
+        if token_type == TokenTypes.IDENTIFIER:
+            return self._identifier()
+        if token_type == TokenTypes.ERROR:
+            self.error_message = "Unexpected character"
+        return token_type
 
     def _is_at_end(self):
-        return len(self.source) == self.current
+        return not self._fill(1)
+
+    def _fill(self, count):
+        """
+        Make sure `count` characters from self.current are in self.source,
+        returning False if the input ends before that.
+        """
+        while self.current + count > self.end:
+            if not self._refill():
+                return False
+        return True
+
+    def _refill(self):
+        """
+        Read more of the input onto the end of self.source, returning False
+        at the end of the input. Everything before self.start may be
+        dropped, so positions in self.source can move.
+        """
+        return False
 
     def _make_token(self, token_type):
         return Token(
-            start=self.start,
+            start=self.offset + self.start,
             length=(self.current - self.start),
-            token_type=token_type
+            token_type=token_type,
+            value=self.number_value,
+            name=self.identifier
         )
 
     def get_token_string(self, token):
         if isinstance(token, ErrorToken):
             return token.message
         else:
-            end_loc = token.start + token.length
-            assert end_loc <= len(self.source)
-            assert end_loc > 0
-            return self.source[token.start:end_loc]
+            return self.get_text(token.start, token.length)
+
+    def get_text(self, start, length):
+        start -= self.offset
+        assert start >= 0
+        end_loc = start + length
+        assert end_loc <= self.end
+        assert end_loc > 0
+        return self.source[start:end_loc]
 
     def advance(self):
         self.current += 1
@@ -106,38 +269,146 @@ class Scanner(object):
         return True
 
     def _skip_whitespace(self):
+        in_comment = False
         while True:
-            char = self._peek()
-            if char in ' \r\t\n':
-                self.advance()
-            elif char == '/':
-                if self._peek_next() == '/':
-                    while self._peek() != '\n' and not self._is_at_end():
-                        self.advance()
-                else:
+            source = self.source
+            current = self.current
+            end = self.end
+            while current < end:
+                if in_comment:
+                    # A comment runs to the end of the line
+                    if source[current] == '\n':
+                        in_comment = False
+                    current += 1
+                    continue
+                token_type = char_class(source[current])
+                if token_type == WHITESPACE:
+                    current += 1
+                elif token_type == TokenTypes.SLASH and current + 1 == end:
+                    # Need the next character to tell if it's a comment
                     break
-            else:
+                elif (token_type == TokenTypes.SLASH and
+                      source[current + 1] == '/'):
+                    in_comment = True
+                    current += 2
+                else:
+                    self.current = current
+                    return
+            self.current = current
+            # Nothing skipped needs to be kept
+            self.start = current
+            if not self._refill():
                 return
 
     def _peek(self):
-        if self.current == len(self.source):
+        if not self._fill(1):
             # At the end
             return '\0'
         return self.source[self.current]
 
     def _peek_next(self):
-        if self._is_at_end():
+        if not self._fill(2):
             return '\0'
         return self.source[self.current+1]
 
     def _number(self):
-        while self._peek().isdigit():
-            self.advance()
+        """
+        Scan a number, computing its value as the digits are scanned.
+        """
+        # Rescan the first digit, which has already been consumed
+        self.current = self.start
+        mantissa = self._scan_digits(0)
+        fraction_digits = 0
 
         # Look for decimal point
-        if self._peek() == '.' and self._peek_next().isdigit():
+        if (self._peek() == '.' and
+                char_class(self._peek_next()) == TokenTypes.NUMBER):
             self.advance()
-            while self._peek().isdigit():
-                self.advance()
+            # Relative to the start, as scanning can move the token
+            fraction_start = self.current - self.start
+            mantissa = self._scan_digits(mantissa)
+            fraction_digits = self.current - self.start - fraction_start
+
+        if mantissa >= 0 and fraction_digits < len(POWERS_OF_TEN):
+            self.number_value = (float(mantissa) /
+                                 POWERS_OF_TEN[fraction_digits])
+        else:
+            # Too many digits to compute exactly, parse the text instead
+            start = self.start
+            end = self.current
+            assert start >= 0 and end >= 0
+            self.number_value = float(self.source[start:end])
+        return TokenTypes.NUMBER
+
+    def _identifier(self):
+        """
+        Scan the rest of a name of letters, digits and underscores.
+        """
+        while True:
+            next_class = char_class(self._peek())
+            if (next_class != TokenTypes.IDENTIFIER and
+                    next_class != TokenTypes.NUMBER):
+                break
+            self.current += 1
+        start = self.start
+        end = self.current
+        assert start >= 0 and end >= 0
+        self.identifier = self.source[start:end]
+        return TokenTypes.IDENTIFIER
+
+    def _scan_digits(self, mantissa):
+        """
+        Skip a run of digits, returning `mantissa` with the digits appended,
+        or -1 once that is no longer exact as a float.
+        """
+        while True:
+            source = self.source
+            current = self.current
+            end = self.end
+            while (current < end and
+                   char_class(source[current]) == TokenTypes.NUMBER):
+                if mantissa >= 0:
+                    if mantissa < MAX_EXACT_MANTISSA // 10:
+                        mantissa = mantissa * 10 + (ord(source[current]) -
+                                                    ord('0'))
+                    else:
+                        mantissa = -1
+                current += 1
+            self.current = current
+            if current < end or not self._refill():
+                return mantissa
+
+
+class StreamScanner(Scanner):
+    """
+    Scans a line of input read a piece at a time from a LineReader, so the
+    line is never held in memory whole: only the token being scanned and
+    the rest of the current piece are kept.
+    """
+
+    def __init__(self, reader, first_piece=""):
+        Scanner.__init__(self, first_piece)
+        self.reader = reader
 
-        return self._make_token(TokenTypes.NUMBER)
+    def _refill(self):
+        piece = self.reader.read_piece()
+        if not piece:
+            return False
+        discard = self.start
+        assert discard >= 0
+        if discard == self.end:
+            self.source = piece
+        else:
+            self.source = self.source[discard:] + piece
+        self.end = len(self.source)
+        self.offset += discard
+        self.start -= discard
+        self.current -= discard
+        return True
+
+    def get_token_string(self, token):
+        if (not isinstance(token, ErrorToken) and
+                token.start < self.offset):
+            # The token's text has already been dropped
+            return TokenTypeToName[token.type]
+        return Scanner.get_token_string(self, token)
@@ -0,0 +1,183 @@
+"""
+A server evaluating expressions for clients connected to a Unix domain
+socket, all multiplexed with poll in one process.
+
+Requests and responses are both a 4 byte big endian length followed by
+that many bytes. A request is the source of an expression. A response is
+"=" followed by the result, or "!" followed by an error message. A client
+can send any number of requests on a connection, and the responses come
+back in the same order.
+"""
+import errno
+import os
+
+from rpython.rlib import rpoll
+from rpython.rlib.rsocket import (AF_UNIX, SOCK_STREAM, CSocketError,
+                                  RSocket, SocketError, UNIXAddress)
+
+READ_SIZE = 2**16
+MAX_REQUEST_SIZE = 2**24
+BACKLOG = 128
+# A connection isn't read from while it has more than this many bytes of
+# responses waiting to be sent, so a client that sends requests without
+# reading the responses can't make the server buffer without limit
+MAX_UNSENT = 2**20
+
+
+def _would_block(e):
+    """
+    Whether a CSocketError from a non-blocking socket only means the call
+    should be retried later.
+    """
+    return (e.errno == errno.EAGAIN or e.errno == errno.EWOULDBLOCK or
+            e.errno == errno.EINTR)
+
+
+def encode_length(length):
+    return (chr((length >> 24) & 0xff) + chr((length >> 16) & 0xff) +
+            chr((length >> 8) & 0xff) + chr(length & 0xff))
+
+
+def decode_length(data, pos):
+    return ((ord(data[pos]) << 24) | (ord(data[pos + 1]) << 16) |
+            (ord(data[pos + 2]) << 8) | ord(data[pos + 3]))
+
+
+class Connection(object):
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.closed = False
+        # Received data, of which everything before `pos` has been handled
+        self.received = ""
+        self.pos = 0
+        # Responses not yet sent
+        self.unsent = ""
+
+    def read(self, evaluator):
+        try:
+            data = self.sock.recv(READ_SIZE)
+        except CSocketError as e:
+            if not _would_block(e):
+                self.closed = True
+            return
+        if not data:
+            self.closed = True
+            return
+        if self.pos == len(self.received):
+            self.received = data
+        else:
+            start = self.pos
+            assert start >= 0
+            self.received = self.received[start:] + data
+        self.pos = 0
+        self._handle_requests(evaluator)
+
+    def _handle_requests(self, evaluator):
+        received = self.received
+        pos = self.pos
+        responses = []
+        while len(received) - pos >= 4:
+            length = decode_length(received, pos)
+            if length > MAX_REQUEST_SIZE:
+                self.closed = True
+                return
+            end = pos + 4 + length
+            if end > len(received):
+                break
+            assert pos >= 0 and end >= 0
+            response = evaluator.evaluate(received[pos + 4:end])
+            responses.append(encode_length(len(response)))
+            responses.append(response)
+            pos = end
+        self.pos = pos
+        if responses:
+            self.unsent += "".join(responses)
+            self.send()
+
+    def send(self):
+        """
+        Send as much of unsent as the socket takes without blocking. The
+        rest is sent when poll says the socket is writable.
+        """
+        try:
+            sent = self.sock.send(self.unsent)
+        except CSocketError as e:
+            if not _would_block(e):
+                self.closed = True
+            return
+        assert sent >= 0
+        self.unsent = self.unsent[sent:]
+
+
+def serve(path, evaluator, stderr):
+    """
+    Serve requests on a Unix domain socket at path until killed, answering
+    each with evaluator.evaluate(source). Returns 1 if the socket can't be
+    set up.
+    """
+    try:
+        os.unlink(path)
+    except OSError:
+        pass
+    try:
+        listener = RSocket(AF_UNIX, SOCK_STREAM)
+        listener.bind(UNIXAddress(path))
+        listener.listen(BACKLOG)
+        listener.setblocking(False)
+    except SocketError as e:
+        stderr.write("can't listen on %s: %s\n" % (path, e.get_msg()))
+        return 1
+
+    connections = {}
+    # False while no more connections can be opened, until one is closed
+    accepting = True
+    while True:
+        fds = {}
+        if accepting:
+            fds[listener.fd] = rpoll.POLLIN
+        for fd, connection in connections.iteritems():
+            events = 0
+            if len(connection.unsent) <= MAX_UNSENT:
+                events |= rpoll.POLLIN
+            if connection.unsent:
+                events |= rpoll.POLLOUT
+            fds[fd] = events
+
+        for fd, events in rpoll.poll(fds, -1):
+            if fd == listener.fd:
+                accepting = _accept(listener, connections, stderr)
+                continue
+            connection = connections.get(fd, None)
+            if connection is None:
+                continue
+            if events & rpoll.POLLOUT:
+                connection.send()
+            if not connection.closed and events & ~rpoll.POLLOUT:
+                connection.read(evaluator)
+            if connection.closed:
+                del connections[fd]
+                connection.sock.close()
+                accepting = True
+
+
+def _accept(listener, connections, stderr):
+    """
+    Accept the connections waiting on listener. Returns False if the
+    process is out of file descriptors, so the listener shouldn't be
+    polled until a connection is closed.
+    """
+    while True:
+        try:
+            fd, address = listener.accept()
+        except CSocketError as e:
+            if e.errno == errno.EINTR:
+                continue
+            if e.errno == errno.EAGAIN or e.errno == errno.EWOULDBLOCK:
+                # No more connections waiting
+                return True
+            stderr.write("can't accept a connection: %s\n" % e.get_msg())
+            return e.errno != errno.EMFILE and e.errno != errno.ENFILE
+        sock = RSocket(AF_UNIX, SOCK_STREAM, fd=fd)
+        sock.setblocking(False)
+        connections[fd] = Connection(sock)
@@ -0,0 +1,483 @@
+import os
+import time
+
+from rpython.rlib import rfile, rstackovf
+from rpython.rlib.objectmodel import (current_object_addr_as_int,
+                                      we_are_translated)
+from compiler import Compiler
+from output import LastResult, OutputBuffer, ResultSink, format_float
+from registervm import RegisterCompiler
+from scanner import Scanner, TokenTypes
+from targetcalc import Options, run_file, run_rows
+from vectorvm import VectorVM
+from vm import VM, select_dispatch
+
+
+def nilakantha(terms):
+    """
+    The Nilakantha series for pi from the readme, to `terms` terms.
+    """
+    parts = []
+    for i in range(terms):
+        n = 2 * (i + 1)
+        if i > 0:
+            parts.append(" - " if i % 2 else " + ")
+        parts.append("(1/(%d * %d * %d))" % (n, n + 1, n + 2))
+    return "3 + 4 * (%s)" % "".join(parts)
+
+
+class _Marker(object):
+    pass
+
+
+def nursery_bytes(vm, chunk):
+    """
+    The bytes one run of chunk on vm allocates in the GC nursery, where
+    every small object is allocated by bumping a pointer: the distance
+    from an object allocated before the run to one allocated after it,
+    less the size of the first. Returns -1 untranslated, or if a minor
+    collection emptied the nursery during the run.
+    """
+    if not we_are_translated():
+        return -1
+    first = _Marker()
+    second = _Marker()
+    marker_size = (current_object_addr_as_int(second) -
+                   current_object_addr_as_int(first))
+    before = current_object_addr_as_int(second)
+    vm.interpret_chunk(chunk)
+    after = current_object_addr_as_int(_Marker())
+    allocated = after - before - marker_size
+    if allocated < 0:
+        return -1
+    return allocated
+
+
+def bench_nilakantha(stdout, stderr, iterations, fold_constants,
+                     superinstructions=False, cache_top=False):
+    compiler = Compiler(nilakantha(50), debugging=False,
+                        fold_constants=fold_constants,
+                        superinstructions=superinstructions)
+    if not compiler.compile():
+        return 1
+    chunk = compiler.chunk
+    output = OutputBuffer(stdout)
+    vm = VM(debug=False, sink=ResultSink(output), cache_top=cache_top)
+
+    start = time.time()
+    for i in range(iterations):
+        vm.interpret_chunk(chunk)
+    output.flush()
+    elapsed = time.time() - start
+
+    name = "nilakantha/%s" % dispatch_name()
+    if fold_constants:
+        name += "/folded"
+    if superinstructions:
+        name += "/super"
+    if cache_top:
+        name += "/tos"
+    report(stderr, name, iterations,
+           len(chunk.code), elapsed)
+
+    # Without the output, whose formatting allocates, so it's only what
+    # the VM itself allocates. A second try is only needed if the first
+    # happened to span a minor collection.
+    vm = VM(debug=False, sink=LastResult(), cache_top=cache_top)
+    vm.interpret_chunk(chunk)
+    allocated = nursery_bytes(vm, chunk)
+    if allocated < 0:
+        allocated = nursery_bytes(vm, chunk)
+    if allocated >= 0:
+        stderr.write("%s: %d bytes allocated per run by the VM\n" % (
+            name, allocated))
+    return 0
+
+
+def bench_parse(stderr, size):
+    """
+    Compile deeply nested and very wide expressions with `size` operators
+    using both the recursive and the iterative parser.
+    """
+    inputs = [
+        ("parens", "(" * size + "1" + ")" * size),
+        ("unary", "-" * size + "1"),
+        ("wide", "1 + " * size + "1"),
+    ]
+    repeats = 10
+    for name, source in inputs:
+        for iterative in [False, True]:
+            label = "parse-%s/%s" % (name,
+                                     "iterative" if iterative else "recursive")
+            start = time.time()
+            try:
+                for i in range(repeats):
+                    compiler = Compiler(source, debugging=False,
+                                        iterative=iterative)
+                    if not compiler.compile():
+                        return 1
+            except rstackovf.StackOverflow:
+                stderr.write("%s: stack overflow at depth %d\n" % (
+                    label, size))
+                continue
+            elapsed = time.time() - start
+            report(stderr, label, repeats, len(source), elapsed)
+    return 0
+
+
+def bench_scan(stderr, terms):
+    """
+    Scan and compile a Nilakantha expression of `terms` terms, one Token
+    object at a time and as a TokenStream.
+    """
+    source = nilakantha(terms)
+    repeats = 10
+
+    start = time.time()
+    count = 0
+    for i in range(repeats):
+        scanner = Scanner(source)
+        while scanner.scan_token().type != TokenTypes.EOF:
+            count += 1
+    report_tokens(stderr, "scan/tokens", count, time.time() - start)
+
+    start = time.time()
+    count = 0
+    for i in range(repeats):
+        count += Scanner(source).scan_all().size() - 1
+    report_tokens(stderr, "scan/stream", count, time.time() - start)
+
+    for token_stream in [False, True]:
+        label = "compile/%s" % ("stream" if token_stream else "tokens")
+        start = time.time()
+        for i in range(repeats):
+            compiler = Compiler(source, debugging=False,
+                                token_stream=token_stream)
+            if not compiler.compile():
+                return 1
+        report_tokens(stderr, label, count, time.time() - start)
+    return 0
+
+
+def bench_scan_bytes(stderr, size):
+    """
+    Scan inputs of about `size` bytes, reporting the throughput in MB/s.
+    """
+    term = nilakantha(1000)
+    inputs = [
+        ("nilakantha", term),
+        ("spaced", "  1.25   *\t( 3 -  -4 )\n  // comment\n + 7 "),
+        ("numbers", "12345.6789 0.5 1024 "),
+        ("long-numbers", "1234567890.0123456789 "),
+    ]
+    for name, unit in inputs:
+        source = unit * (size // len(unit) + 1)
+        repeats = 10
+        start = time.time()
+        for i in range(repeats):
+            Scanner(source).scan_all()
+        elapsed = time.time() - start
+        if elapsed <= 0.0:
+            elapsed = 1e-9
+        megabytes = repeats * len(source) / (1024.0 * 1024.0)
+        stderr.write("scan-bytes/%s: %d bytes in %f s, %f MB/s\n" % (
+            name, repeats * len(source), elapsed, megabytes / elapsed))
+    return 0
+
+
+def random_expression(terms):
+    """
+    An expression of `terms` terms with mixed operators and groupings.
+    """
+    parts = []
+    seed = 12345
+    depth = 0
+    for i in range(terms):
+        # A linear congruential generator, for operands that vary
+        seed = (seed * 1103515245 + 12345) & 0x7fffffff
+        if i > 0:
+            parts.append(" %s " % "+-*/"[seed % 4])
+        if seed % 5 == 0 and depth < 20:
+            parts.append("(")
+            depth += 1
+        parts.append("%d.%d" % (seed % 1000, seed % 97))
+        if seed % 7 == 0 and depth > 0:
+            parts.append(")")
+            depth -= 1
+    parts.append(")" * depth)
+    return "".join(parts)
+
+
+def bench_registers(stdout, stderr, iterations):
+    """
+    Compare the code size, instruction count and speed of the stack VM
+    and the RegisterVM on the same expressions.
+    """
+    inputs = [
+        ("nilakantha", nilakantha(50)),
+        ("random", random_expression(1000)),
+    ]
+    output = OutputBuffer(stdout)
+    for name, source in inputs:
+        compiler = Compiler(source, debugging=False)
+        if not compiler.compile():
+            return 1
+        chunk = compiler.chunk
+        register_compiler = RegisterCompiler(chunk)
+        if register_compiler.compile() is None:
+            return 1
+        stderr.write("registers/%s:\n%s\n" % (name,
+                                               register_compiler.report()))
+        for registers in [False, True]:
+            vm = VM(debug=False, sink=ResultSink(output),
+                    registers=registers)
+            start = time.time()
+            for i in range(iterations):
+                vm.interpret_chunk(chunk)
+            output.flush()
+            elapsed = time.time() - start
+            label = "registers/%s/%s" % (
+                name, "registers" if registers else "stack")
+            report(stderr, label, iterations, len(source), elapsed)
+    return 0
+
+
+def bench_rows(stdout, stderr, rows):
+    """
+    Evaluate a formula over `rows` rows of three values: compiling a
+    source per row with the values as literals, compiling once and
+    binding the values to variables, and with calc --eval over a CSV
+    file.
+    """
+    names = ["price", "qty", "tax_rate"]
+    formula = "price * qty * (1 + tax_rate) - qty / 2"
+    values = []
+    seed = 12345
+    for i in range(rows * len(names)):
+        # A linear congruential generator, for values that vary
+        seed = (seed * 1103515245 + 12345) & 0x7fffffff
+        values.append((seed % 100000) / 100.0)
+
+    output = OutputBuffer(stdout)
+    vm = VM(debug=False, sink=ResultSink(output))
+    start = time.time()
+    for row in range(rows):
+        price = format_float(values[3 * row])
+        qty = format_float(values[3 * row + 1])
+        tax_rate = format_float(values[3 * row + 2])
+        source = "%s * %s * (1 + %s) - %s / 2" % (price, qty, tax_rate, qty)
+        compiler = Compiler(source, debugging=False)
+        if not compiler.compile():
+            return 1
+        vm.interpret_chunk(compiler.chunk)
+    output.flush()
+    report(stderr, "rows/compile-each", rows, 0, time.time() - start)
+
+    compiler = Compiler(formula, debugging=False, variables=names)
+    if not compiler.compile():
+        return 1
+    vm.variables = [0.0] * len(names)
+    start = time.time()
+    for row in range(rows):
+        for i in range(len(names)):
+            vm.variables[i] = values[3 * row + i]
+        vm.interpret_chunk(compiler.chunk)
+    output.flush()
+    report(stderr, "rows/compile-once", rows, 0, time.time() - start)
+
+    path = "/tmp/calc-bench-rows-%d.csv" % os.getpid()
+    file = rfile.create_file(path, "wb")
+    file.write(",".join(names) + "\n")
+    for row in range(rows):
+        file.write("%s,%s,%s\n" % (format_float(values[3 * row]),
+                                    format_float(values[3 * row + 1]),
+                                    format_float(values[3 * row + 2])))
+    file.close()
+    options = Options()
+    options.eval = formula
+    options.csv = path
+    stderr.write("rows/csv: ")
+    result = run_rows(options, stdout, stderr)
+    os.unlink(path)
+    return result
+
+
+def bench_vector(stderr, rows):
+    """
+    Evaluate a formula over `rows` rows of three columns with the scalar
+    VM, a row at a time, and with the VectorVM at several block sizes.
+    The sum of the results checks that they agree.
+    """
+    names = ["price", "qty", "tax_rate"]
+    formula = "price * qty * (1 + tax_rate) - qty / 2"
+    columns = [[0.0] * rows for name in names]
+    seed = 12345
+    for row in range(rows):
+        for i in range(len(names)):
+            seed = (seed * 1103515245 + 12345) & 0x7fffffff
+            columns[i][row] = (seed % 100000) / 100.0
+
+    compiler = Compiler(formula, debugging=False, variables=names,
+                        superinstructions=True)
+    if not compiler.compile():
+        return 1
+    chunk = compiler.chunk
+
+    sink = LastResult()
+    vm = VM(debug=False, sink=sink)
+    vm.variables = [0.0] * len(names)
+    total = 0.0
+    start = time.time()
+    for row in range(rows):
+        for i in range(len(names)):
+            vm.variables[i] = columns[i][row]
+        vm.interpret_chunk(chunk)
+        total += sink.value
+    report(stderr, "vector/scalar", rows, 0, time.time() - start)
+    expected = total
+
+    block_sizes = [1, 64, 1024, 8192]
+    for size_index in range(len(block_sizes)):
+        block_size = block_sizes[size_index]
+        vector_vm = VectorVM(block_size)
+        total = 0.0
+        start = time.time()
+        row = 0
+        while row < rows:
+            count = min(block_size, rows - row)
+            results = vector_vm.run(chunk, columns, row, count)
+            if results is None:
+                return 1
+            for i in range(count):
+                total += results[i]
+            row += count
+        name = "vector/block-%d" % block_size
+        report(stderr, name, rows, 0, time.time() - start)
+        if total != expected:
+            stderr.write("%s: results differ from the scalar VM\n" % name)
+            return 1
+    return 0
+
+
+def bench_jobs(stdout, stderr, lines):
+    """
+    Evaluate a file of `lines` expressions with calc --file, using 1, 2, 4
+    and 8 worker processes.
+    """
+    path = "/tmp/calc-bench-jobs-%d.txt" % os.getpid()
+    file = rfile.create_file(path, "wb")
+    seed = 12345
+    for i in range(lines):
+        # A linear congruential generator, for operands that vary
+        seed = (seed * 1103515245 + 12345) & 0x7fffffff
+        file.write("(%d.%d + %d) * %d / -%d\n" % (
+            seed % 10000, seed % 97, seed % 1000, seed % 99 + 1,
+            seed % 9 + 1))
+    file.close()
+
+    for jobs in [1, 2, 4, 8]:
+        options = Options()
+        options.file = path
+        options.jobs = jobs
+        stderr.write("jobs/%d: " % jobs)
+        if run_file(path, options, stdout, stderr) != 0:
+            os.unlink(path)
+            return 1
+    os.unlink(path)
+    return 0
+
+
+def report_tokens(stderr, name, tokens, elapsed):
+    if elapsed <= 0.0:
+        elapsed = 1e-9
+    stderr.write("%s: %d tokens in %f s, %f tokens/s\n" % (
+        name, tokens, elapsed, tokens / elapsed))
+
+
+def dispatch_name():
+    if VM.DISPATCH_TABLE:
+        return "table"
+    return "switch"
+
+
+def report(stderr, name, iterations, size, elapsed):
+    if elapsed <= 0.0:
+        elapsed = 1e-9
+    stderr.write("%s: %d runs over %d bytes in %f s\n" % (
+        name, iterations, size, elapsed))
+    stderr.write("%s: %f runs/s, %f ns/run\n" % (
+        name, iterations / elapsed, elapsed * 1e9 / iterations))
+
+
+def entry_point(argv):
+    """
+    Results are printed to stdout and the timings to stderr, so run with
+    something like:
+
+        ./calc-bench nilakantha 100000 > /dev/null
+
+    Running with PYPYLOG=gc-minor:gc.log also records every nursery
+    collection, which gives the allocation count of a run.
+    """
+    stdin, stdout, stderr = rfile.create_stdio()
+    if len(argv) < 2:
+        stderr.write("usage: %s nilakantha[-fold|-super|-tos|-super-tos]"
+                     " [iterations]\n"
+                     "       %s parse|scan|scan-bytes [size]\n"
+                     "       %s jobs [lines]\n"
+                     "       %s registers [iterations]\n"
+                     "       %s rows|vector [rows]\n" % (
+                         argv[0], argv[0], argv[0], argv[0], argv[0]))
+        return 1
+
+    iterations = 10000
+    if len(argv) > 2:
+        iterations = int(argv[2])
+
+    if argv[1] == "nilakantha":
+        return bench_nilakantha(stdout, stderr, iterations, False)
+    if argv[1] == "nilakantha-fold":
+        return bench_nilakantha(stdout, stderr, iterations, True)
+    if argv[1] == "nilakantha-super":
+        return bench_nilakantha(stdout, stderr, iterations, False, True)
+    if argv[1] == "nilakantha-tos":
+        return bench_nilakantha(stdout, stderr, iterations, False, False,
+                                True)
+    if argv[1] == "nilakantha-super-tos":
+        return bench_nilakantha(stdout, stderr, iterations, False, True, True)
+    if argv[1] == "parse":
+        return bench_parse(stderr, iterations)
+    if argv[1] == "scan":
+        return bench_scan(stderr, iterations)
+    if argv[1] == "scan-bytes":
+        return bench_scan_bytes(stderr, iterations)
+    if argv[1] == "jobs":
+        return bench_jobs(stdout, stderr, iterations)
+    if argv[1] == "registers":
+        return bench_registers(stdout, stderr, iterations)
+    if argv[1] == "rows":
+        return bench_rows(stdout, stderr, iterations)
+    if argv[1] == "vector":
+        return bench_vector(stderr, iterations)
+
+    stderr.write("unknown benchmark %s\n" % argv[1])
+    return 1
+
+
+def target(driver, args):
+    select_dispatch(args)
+    if driver.config.translation.jit:
+        driver.exe_name = "calc-bench-jit"
+    else:
+        driver.exe_name = "calc-bench"
+    return entry_point, None
+
+
+def jitpolicy(driver):
+    from rpython.jit.codewriter.policy import JitPolicy
+    return JitPolicy()
+
+
+if __name__ == '__main__':
+    import sys
+    entry_point(sys.argv)
@@ -1,31 +1,626 @@
-from rpython.rlib import rfile
+import os
+import time
+
+from rpython.rlib import rfile, rmmap
+from bytecode import BytecodeError, dump_chunk, load_chunk
+from jobs import ReorderBuffer, WorkerOutput
+from cache import ChunkCache, normalize_source
+from columns import ColumnError, CsvRows, RawColumns
 from compiler import Compiler
-from vm import VM
+from peephole import optimize_chunk
+from pairs import OpcodePairs
+from output import LastResult, OutputBuffer, ResultSink, format_float
+from reader import LineReader, MappedFile
+from scanner import WHITESPACE, Scanner, StreamScanner, char_class
+from server import serve
+from vectorvm import VectorVM
+from vm import VM, InterpretResultCode, select_dispatch
 
-LINE_BUFFER_LENGTH = 2**20
+# How much of a mapped file is copied out to scan at a time
+WINDOW_SIZE = 2**20
+# Smaller with --jobs, where each window is a batch for one worker
+JOB_WINDOW_SIZE = 2**18
 
+USAGE = ("usage: %s [--trace] [--fold] [--optimize] [--iterative]\n"
+         "       [--token-stream] [--cache-size N] [--cache-stats]\n"
+         "       [--superinstructions] [--pair-stats] [--cache-top]\n"
+         "       [--registers]\n"
+         "       [--file PATH [--jobs N] | --serve SOCKET |\n"
+         "        --compile SRC -o OUT | --run OUT |\n"
+         "        --eval EXPR (--csv PATH | --raw PATH --columns A,B,...)\n"
+         "        [--block N]]\n")
+
+
+class Options(object):
+    def __init__(self):
+        self.trace = False
+        self.fold_constants = False
+        self.optimize = False
+        self.iterative = False
+        self.token_stream = False
+        self.cache_size = 256
+        self.cache_stats = False
+        self.superinstructions = False
+        self.pair_stats = False
+        self.cache_top = False
+        self.registers = False
+        self.eval = None
+        self.csv = None
+        self.raw = None
+        # The names of the --raw columns
+        self.columns = []
+        # Evaluate --eval over blocks of this many rows with a VectorVM,
+        # rather than a row at a time
+        self.block_size = 0
+        self.file = None
+        self.jobs = 1
+        self.serve = None
+        self.compile = None
+        self.compile_output = None
+        self.run = None
+
+
+def parse_args(argv):
+    """
+    Returns the Options given on the command line, or None if they
+    aren't valid.
+    """
+    options = Options()
+    i = 1
+    while i < len(argv):
+        arg = argv[i]
+        if arg == "--trace":
+            options.trace = True
+        elif arg == "--fold":
+            options.fold_constants = True
+        elif arg == "--optimize":
+            options.optimize = True
+        elif arg == "--iterative":
+            options.iterative = True
+        elif arg == "--token-stream":
+            options.token_stream = True
+        elif arg == "--cache-size" and i + 1 < len(argv):
+            i += 1
+            try:
+                options.cache_size = int(argv[i])
+            except ValueError:
+                return None
+        elif arg == "--cache-stats":
+            options.cache_stats = True
+        elif arg == "--superinstructions":
+            options.superinstructions = True
+        elif arg == "--pair-stats":
+            options.pair_stats = True
+        elif arg == "--cache-top":
+            options.cache_top = True
+        elif arg == "--registers":
+            options.registers = True
+        elif arg == "--eval" and i + 1 < len(argv):
+            i += 1
+            options.eval = argv[i]
+        elif arg == "--csv" and i + 1 < len(argv):
+            i += 1
+            options.csv = argv[i]
+        elif arg == "--raw" and i + 1 < len(argv):
+            i += 1
+            options.raw = argv[i]
+        elif arg == "--columns" and i + 1 < len(argv):
+            i += 1
+            options.columns = argv[i].split(",")
+        elif arg == "--block" and i + 1 < len(argv):
+            i += 1
+            try:
+                options.block_size = int(argv[i])
+            except ValueError:
+                return None
+        elif arg == "--file" and i + 1 < len(argv):
+            i += 1
+            options.file = argv[i]
+        elif arg == "--jobs" and i + 1 < len(argv):
+            i += 1
+            try:
+                options.jobs = int(argv[i])
+            except ValueError:
+                return None
+        elif arg == "--serve" and i + 1 < len(argv):
+            i += 1
+            options.serve = argv[i]
+        elif arg == "--compile" and i + 1 < len(argv):
+            i += 1
+            options.compile = argv[i]
+        elif arg == "-o" and i + 1 < len(argv):
+            i += 1
+            options.compile_output = argv[i]
+        elif arg == "--run" and i + 1 < len(argv):
+            i += 1
+            options.run = argv[i]
+        else:
+            return None
+        i += 1
+    if options.jobs < 1 or (options.jobs > 1 and options.file is None):
+        return None
+    if options.pair_stats and options.jobs > 1:
+        return None
+    modes = 0
+    for mode in [options.file, options.serve, options.compile, options.run,
+                 options.eval]:
+        if mode is not None:
+            modes += 1
+    if modes > 1:
+        return None
+    if (options.compile is None) != (options.compile_output is None):
+        return None
+    if options.eval is not None:
+        # Rows come from exactly one of --csv and --raw, which needs names
+        if (options.csv is None) == (options.raw is None):
+            return None
+        if (options.raw is None) != (len(options.columns) == 0):
+            return None
+    elif (options.csv is not None or options.raw is not None or
+            len(options.columns) > 0 or options.block_size != 0):
+        return None
+    if options.block_size < 0:
+        return None
+    return options
+
+
+def compile_source(source, options, scanner=None, variables=None,
+                   output=None):
+    """
+    Compile (and optionally optimize) source, or the input of scanner if
+    one is given, returning the chunk or None if it failed to compile.
+    `variables` are the names of the variables it may use, by slot. Error
+    messages go to output, in order with the results, if it's given.
+    """
+    compiler = Compiler(source, debugging=options.trace,
+                        fold_constants=options.fold_constants,
+                        iterative=options.iterative,
+                        token_stream=options.token_stream,
+                        scanner=scanner,
+                        superinstructions=options.superinstructions,
+                        variables=variables, output=output)
+    if not compiler.compile():
+        return None
+    if options.optimize:
+        removed = optimize_chunk(compiler.chunk, options.superinstructions)
+        if options.trace:
+            print "peephole removed %d instructions\n" % removed
+            compiler.chunk.disassemble("optimized")
+    if options.trace:
+        print compiler.chunk.memory_report()
+    return compiler.chunk
+
+
+def cached_compile(cache, source, options, output=None):
+    key = normalize_source(source)
+    if key is None:
+        # Compile anyway, to report the errors
+        return compile_source(source, options, output=output)
+    chunk = cache.get(key)
+    if chunk is None:
+        chunk = compile_source(source, options, output=output)
+        if chunk is not None:
+            cache.put(key, chunk)
+    return chunk
+
+
+def new_vm(options, sink):
+    """
+    A VM sending its results to sink, counting instruction pairs with
+    --pair-stats, caching the top of the stack with --cache-top and
+    running register code with --registers.
+    """
+    pairs = None
+    if options.pair_stats:
+        pairs = OpcodePairs()
+    return VM(debug=options.trace, sink=sink, pairs=pairs,
+              cache_top=options.cache_top, registers=options.registers)
+
+
+def report_pairs(vm, stderr):
+    if vm.pairs is not None:
+        stderr.write(vm.pairs.report() + "\n")
+
+
+def _is_blank(source, start, end):
+    for i in range(start, end):
+        if char_class(source[i]) != WHITESPACE:
+            return False
+    return True
+
+
+def run_window(vm, window, options, output):
+    """
+    Evaluate every line of window, each scanned in place, writing any
+    compile errors to output. Returns the number of lines evaluated.
+    """
+    lines = 0
+    line_start = 0
+    while line_start < len(window):
+        assert line_start >= 0
+        line_end = window.find('\n', line_start)
+        if line_end == -1:
+            line_end = len(window)
+        if not _is_blank(window, line_start, line_end):
+            chunk = compile_source("", options,
+                                   Scanner(window, line_start, line_end),
+                                   output=output)
+            if chunk is not None:
+                vm.interpret_chunk(chunk)
+            lines += 1
+        line_start = line_end + 1
+    return lines
+
+
+def run_file(path, options, stdout, stderr):
+    """
+    Evaluate every line of the file at path, reading it through a memory
+    mapping a window of whole lines at a time. Lines are compiled straight
+    from the window, so they aren't copied out one by one, and aren't
+    cached either.
+    """
+    try:
+        mapped = MappedFile(path)
+    except OSError:
+        stderr.write("can't open %s\n" % path)
+        return 1
+    except rmmap.RMMapError:
+        stderr.write("can't map %s\n" % path)
+        return 1
+
+    output = OutputBuffer(stdout)
+    start = time.time()
+    if options.jobs > 1:
+        lines = run_jobs(mapped, options, output, stderr)
+    else:
+        vm = new_vm(options, ResultSink(output))
+        lines = 0
+        pos = 0
+        while pos < mapped.size:
+            end = mapped.window_end(pos, WINDOW_SIZE)
+            lines += run_window(vm, mapped.window(pos, end), options,
+                                output)
+            pos = end
+        report_pairs(vm, stderr)
+    output.flush()
+    elapsed = time.time() - start
+    mapped.close()
+    if lines < 0:
+        return 1
+
+    if elapsed <= 0.0:
+        elapsed = 1e-9
+    stderr.write("%d lines, %d bytes in %f s: %f lines/s, %f bytes/s\n" % (
+        lines, mapped.size, elapsed, lines / elapsed,
+        mapped.size / elapsed))
+    return 0
+
+
+def run_jobs(mapped, options, output, stderr):
+    """
+    Evaluate the mapped file with options.jobs worker processes, each with
+    its own VM, writing the results to output in input order. Returns the
+    number of lines evaluated, or -1 if a worker failed.
+    """
+    workers = []
+    for index in range(options.jobs):
+        read_fd, write_fd = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            for worker in workers:
+                os.close(worker.fd)
+            os.close(read_fd)
+            # Whatever happens, the child must never return into the
+            # parent's code
+            code = 1
+            try:
+                code = run_worker(mapped, options, index, write_fd)
+            finally:
+                os._exit(code)
+        os.close(write_fd)
+        workers.append(WorkerOutput(pid, read_fd))
+
+    reorder = ReorderBuffer(workers, output)
+    ok = reorder.run()
+    for worker in workers:
+        if not worker.closed:
+            os.close(worker.fd)
+        pid, status = os.waitpid(worker.pid, 0)
+        if not os.WIFEXITED(status) or os.WEXITSTATUS(status) != 0:
+            ok = False
+    if not ok:
+        stderr.write("a worker failed\n")
+        return -1
+    return reorder.lines
+
+
+def run_worker(mapped, options, index, write_fd):
+    """
+    The body of worker process `index`: evaluate every options.jobs'th
+    window of the mapped file, sending the results down write_fd.
+    """
+    # Tracing prints, keep it out of stdout
+    os.dup2(2, 1)
+    output = OutputBuffer(rfile.create_fdopen_rfile(write_fd, "wb"))
+    vm = new_vm(options, ResultSink(output))
+    batch = 0
+    pos = 0
+    while pos < mapped.size:
+        end = mapped.window_end(pos, JOB_WINDOW_SIZE)
+        if batch % options.jobs == index:
+            lines = run_window(vm, mapped.window(pos, end), options,
+                               output)
+            output.write("#%d\n" % lines)
+        batch += 1
+        pos = end
+    output.flush()
+    return 0
+
+
+def read_file(path):
+    fd = os.open(path, os.O_RDONLY, 0)
+    try:
+        size = os.fstat(fd).st_size
+        parts = []
+        while size > 0:
+            data = os.read(fd, size)
+            if not data:
+                break
+            parts.append(data)
+            size -= len(data)
+        return "".join(parts)
+    finally:
+        os.close(fd)
 
-def entry_point(argv):
-    stdin, stdout, stderr = rfile.create_stdio()
-    vm = VM()
 
+def write_file(path, data):
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0644)
+    try:
+        while data:
+            written = os.write(fd, data)
+            data = data[written:]
+    finally:
+        os.close(fd)
+
+
+def compile_file(source_path, output_path, options, stderr):
+    """
+    Compile the expression in the file at source_path, saving the chunk
+    to output_path.
+    """
+    try:
+        source = read_file(source_path)
+    except OSError:
+        stderr.write("can't read %s\n" % source_path)
+        return 1
+    chunk = compile_source(source, options)
+    if chunk is None:
+        return 1
+    try:
+        write_file(output_path, dump_chunk(chunk))
+    except OSError:
+        stderr.write("can't write %s\n" % output_path)
+        return 1
+    return 0
+
+
+def run_compiled(path, options, stdout, stderr):
+    """
+    Run a chunk saved by compile_file, without its source.
+    """
+    try:
+        chunk = load_chunk(read_file(path))
+    except OSError:
+        stderr.write("can't read %s\n" % path)
+        return 1
+    except BytecodeError as e:
+        stderr.write("%s: %s\n" % (path, e.message))
+        return 1
+    if chunk.variable_count > 0:
+        stderr.write("%s: uses variables, which can't be bound with --run\n"
+                     % path)
+        return 1
+    if options.trace:
+        chunk.disassemble("loaded")
+    output = OutputBuffer(stdout)
+    vm = new_vm(options, ResultSink(output))
+    result = vm.interpret_chunk(chunk)
+    output.flush()
+    report_pairs(vm, stderr)
+    if result != InterpretResultCode.INTERPRET_OK:
+        return 1
+    return 0
+
+
+def run_rows(options, stdout, stderr):
+    """
+    Compile options.eval once, then evaluate it for every row of the
+    --csv or --raw input, with its variables bound to the row's columns.
+    """
+    if options.csv is not None:
+        path = options.csv
+    else:
+        path = options.raw
+    try:
+        mapped = MappedFile(path)
+    except OSError:
+        stderr.write("can't open %s\n" % path)
+        return 1
+    except rmmap.RMMapError:
+        stderr.write("can't map %s\n" % path)
+        return 1
+
+    try:
+        result = _run_rows(mapped, options, stdout, stderr)
+    except ColumnError as e:
+        stderr.write("%s: %s\n" % (path, e.message))
+        result = 1
+    mapped.close()
+    return result
+
+
+def _run_rows(mapped, options, stdout, stderr):
+    if options.csv is not None:
+        rows = CsvRows(mapped)
+    else:
+        rows = RawColumns(mapped, options.columns)
+    chunk = compile_source(options.eval, options, variables=rows.names)
+    if chunk is None:
+        return 1
+
+    output = OutputBuffer(stdout)
+    if options.block_size > 0:
+        return _run_row_blocks(rows, chunk, options, output, stderr)
+    vm = new_vm(options, ResultSink(output))
+    vm.variables = [0.0] * len(rows.names)
+    start = time.time()
+    result = vm.interpret_rows(chunk, rows)
+    count = vm.rows_run
+    if result != InterpretResultCode.INTERPRET_OK:
+        output.flush()
+        stderr.write("runtime error in row %d\n" % (count + 1))
+        return 1
+    output.flush()
+    elapsed = time.time() - start
+    report_pairs(vm, stderr)
+
+    if elapsed <= 0.0:
+        elapsed = 1e-9
+    stderr.write("%d rows in %f s: %f rows/s\n" % (
+        count, elapsed, count / elapsed))
+    return 0
+
+
+def _run_row_blocks(rows, chunk, options, output, stderr):
+    """
+    Evaluate chunk for every row, options.block_size rows at a time on a
+    VectorVM.
+    """
+    block_size = options.block_size
+    vm = VectorVM(block_size)
+    sink = ResultSink(output)
+    columns = [[0.0] * block_size for name in rows.names]
+    row = [0.0] * len(rows.names)
+    count = 0
+    start = time.time()
     while True:
-        stdout.write("> ")
-        source = stdin.readline(LINE_BUFFER_LENGTH).strip()
-        if not source:
+        filled = 0
+        while filled < block_size and rows.next_row(row):
+            for i in range(len(row)):
+                columns[i][filled] = row[i]
+            filled += 1
+        if filled == 0:
             break
-        compiler = Compiler(source, debugging=True)
+        results = vm.run(chunk, columns, 0, filled)
+        if results is None:
+            output.flush()
+            stderr.write("runtime error in rows %d to %d\n" % (
+                count + 1, count + filled))
+            return 1
+        for i in range(filled):
+            sink.write_result(results[i])
+        count += filled
+    output.flush()
+    elapsed = time.time() - start
 
-        if compiler.compile():
-            vm.interpret_chunk(compiler.chunk)
+    if elapsed <= 0.0:
+        elapsed = 1e-9
+    stderr.write("%d rows in %f s: %f rows/s\n" % (
+        count, elapsed, count / elapsed))
+    return 0
+
+
+class Evaluator(object):
+    """
+    Evaluates the requests to a server, with one VM and chunk cache shared
+    by every client.
+    """
+
+    def __init__(self, options):
+        self.options = options
+        self.result = LastResult()
+        self.vm = new_vm(options, self.result)
+        self.cache = ChunkCache(options.cache_size)
 
+    def evaluate(self, source):
+        chunk = cached_compile(self.cache, source, self.options)
+        if chunk is None:
+            return "!compile error"
+        if (self.vm.interpret_chunk(chunk) !=
+                InterpretResultCode.INTERPRET_OK):
+            return "!runtime error"
+        return "=" + format_float(self.result.value)
+
+
+def entry_point(argv):
+    stdin, stdout, stderr = rfile.create_stdio()
+
+    options = parse_args(argv)
+    if options is None:
+        stderr.write(USAGE % argv[0])
+        return 1
+    if options.file is not None:
+        return run_file(options.file, options, stdout, stderr)
+    if options.serve is not None:
+        return serve(options.serve, Evaluator(options), stderr)
+    if options.compile is not None:
+        return compile_file(options.compile, options.compile_output,
+                            options, stderr)
+    if options.run is not None:
+        return run_compiled(options.run, options, stdout, stderr)
+    if options.eval is not None:
+        return run_rows(options, stdout, stderr)
+
+    # Interactively, and when tracing, which prints as it goes, output is
+    # flushed a line at a time. Otherwise it's written in large blocks.
+    interactive = stdin.isatty() or options.trace
+    output = OutputBuffer(stdout, line_buffered=interactive)
+    vm = new_vm(options, ResultSink(output))
+    cache = ChunkCache(options.cache_size)
+    reader = LineReader(stdin)
+
+    while True:
+        output.write("> ")
+        if interactive:
+            output.flush()
+        piece = reader.read_piece()
+        if reader.at_line_end():
+            # The whole line fits in one piece
+            source = piece.strip()
+            if not source:
+                break
+            chunk = cached_compile(cache, source, options, output)
+        else:
+            # Too long to hold whole, so stream it through the compiler.
+            # Such lines are never cached.
+            chunk = compile_source("", options,
+                                   StreamScanner(reader, piece),
+                                   output=output)
+        reader.next_line()
+        if chunk is not None:
+            vm.interpret_chunk(chunk)
+
+    output.flush()
+    if options.cache_stats:
+        stderr.write(cache.stats() + "\n")
+    report_pairs(vm, stderr)
     return 0
 
 
-def target(driver, *args):
-    driver.exe_name = "calc"
+def target(driver, args):
+    select_dispatch(args)
+    if driver.config.translation.jit:
+        driver.exe_name = "calc-jit"
+    else:
+        driver.exe_name = "calc"
     return entry_point, None
 
 
+def jitpolicy(driver):
+    from rpython.jit.codewriter.policy import JitPolicy
+    return JitPolicy()
+
+
 if __name__ == '__main__':
-    entry_point([])
\ No newline at end of file
+    import sys
+    entry_point(sys.argv)
\ No newline at end of file
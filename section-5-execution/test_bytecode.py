@@ -0,0 +1,76 @@
+import math
+
+import pytest
+
+from bytecode import (FORMAT_VERSION, HEADER_SIZE, BytecodeError,
+                      dump_chunk, load_chunk, read_double)
+from chunk import Chunk
+from compiler import Compiler
+from opcodes import OpCode
+
+
+def compile_chunk(source, **options):
+    compiler = Compiler(source, debugging=False, **options)
+    assert compiler.compile()
+    return compiler.chunk
+
+
+def same_float(a, b):
+    if math.isnan(a):
+        return math.isnan(b)
+    return a == b and math.copysign(1.0, a) == math.copysign(1.0, b)
+
+
+@pytest.mark.parametrize("source, options", [
+    ("1 + 2 * 3", {}),
+    ("-5", {"fold_constants": True}),
+    ("0-2.5", {"fold_constants": True}),
+    ("(1 - 2) * 3 / 4 + -5", {"superinstructions": True}),
+    ("price * qty - qty / 2", {"variables": ["price", "qty"]}),
+])
+def test_round_trip(source, options):
+    chunk = compile_chunk(source, **options)
+    loaded = load_chunk(dump_chunk(chunk))
+    assert loaded.code == chunk.code
+    assert loaded.constants == chunk.constants
+    assert loaded.max_stack_depth == chunk.compute_max_stack_depth()
+    assert loaded.variable_count == chunk.variable_count
+
+
+def test_special_constants():
+    values = [-1.5, -0.0, 0.0, float("inf"), float("-inf"), float("nan"),
+              -1e-310, 1.7976931348623157e308]
+    chunk = Chunk()
+    for value in values:
+        chunk.write_constant(chunk.add_constant(value))
+    for i in range(len(values) - 1):
+        chunk.write_chunk(OpCode.OP_ADD)
+    chunk.write_chunk(OpCode.OP_RETURN)
+
+    loaded = load_chunk(dump_chunk(chunk))
+    assert len(loaded.constants) == len(chunk.constants)
+    for i in range(len(chunk.constants)):
+        assert same_float(loaded.constants[i], chunk.constants[i])
+
+
+def test_read_double_sign_bit():
+    assert read_double("\x00" * 7 + "\x80", 0) == 0.0
+    assert math.copysign(1.0, read_double("\x00" * 7 + "\x80", 0)) < 0.0
+    assert read_double("\xff" + "\x00\x00\x00\x00\x00\x00\x04\xc0", 1) == -2.5
+
+
+def test_rejects_other_versions():
+    data = dump_chunk(compile_chunk("1 + 2"))
+    old = data[:4] + chr(FORMAT_VERSION - 1) + data[5:]
+    with pytest.raises(BytecodeError):
+        load_chunk(old)
+
+
+def test_rejects_corruption():
+    data = dump_chunk(compile_chunk("1 + 2"))
+    corrupt = data[:HEADER_SIZE] + chr(ord(data[HEADER_SIZE]) ^ 1)
+    corrupt += data[HEADER_SIZE + 1:]
+    with pytest.raises(BytecodeError):
+        load_chunk(corrupt)
+    with pytest.raises(BytecodeError):
+        load_chunk(data[:-1])
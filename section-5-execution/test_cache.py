@@ -0,0 +1,75 @@
+from cache import ChunkCache, normalize_source
+
+
+def test_normalize_source():
+    assert normalize_source("1+2") == "1 + 2"
+    assert normalize_source("  1 +\t2 ") == "1 + 2"
+    assert normalize_source("1 + 2 // three") == "1 + 2"
+    assert normalize_source("(a*-3.5)/b") == "( a * - 3.5 ) / b"
+    assert normalize_source("") == ""
+
+
+def test_normalize_source_errors():
+    assert normalize_source("1 $ 2") is None
+    assert normalize_source("#") is None
+
+
+def keys(cache):
+    result = []
+    entry = cache.newest
+    while entry is not None:
+        result.append(entry.key)
+        entry = entry.older
+    return result
+
+
+def test_evicts_least_recently_used():
+    cache = ChunkCache(2)
+    cache.put("a", "A")
+    cache.put("b", "B")
+    cache.put("c", "C")
+    assert keys(cache) == ["c", "b"]
+    assert cache.get("a") is None
+    assert cache.get("b") == "B"
+    assert cache.get("c") == "C"
+    assert cache.evictions == 1
+
+
+def test_get_makes_entry_newest():
+    cache = ChunkCache(3)
+    for key in ["a", "b", "c"]:
+        cache.put(key, key.upper())
+    assert cache.get("a") == "A"
+    assert keys(cache) == ["a", "c", "b"]
+    cache.put("d", "D")
+    assert keys(cache) == ["d", "a", "c"]
+    assert cache.oldest.key == "c"
+
+
+def test_put_replaces_entry():
+    cache = ChunkCache(2)
+    cache.put("a", "A")
+    cache.put("b", "B")
+    cache.put("a", "A2")
+    assert keys(cache) == ["a", "b"]
+    assert cache.get("a") == "A2"
+    assert cache.evictions == 0
+
+
+def test_counters():
+    cache = ChunkCache(1)
+    assert cache.get("a") is None
+    cache.put("a", "A")
+    assert cache.get("a") == "A"
+    assert cache.get("a") == "A"
+    cache.put("b", "B")
+    assert (cache.hits, cache.misses, cache.evictions) == (2, 1, 1)
+    assert cache.stats() == "cache: 2 hits, 1 misses, 1 evictions, 1/1 entries"
+
+
+def test_capacity_zero():
+    cache = ChunkCache(0)
+    cache.put("a", "A")
+    assert cache.get("a") is None
+    assert keys(cache) == []
+    assert (cache.hits, cache.misses, cache.evictions) == (0, 1, 0)
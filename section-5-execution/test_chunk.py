@@ -0,0 +1,43 @@
+import math
+
+from chunk import Chunk
+
+
+def test_add_constant_dedup():
+    chunk = Chunk()
+    assert chunk.add_constant(1.5) == chunk.add_constant(1.5)
+    assert chunk.add_constant(2.0) != chunk.add_constant(1.5)
+    assert len(chunk.constants) == 2
+
+
+def test_signed_zeros():
+    chunk = Chunk()
+    zero = chunk.add_constant(0.0)
+    negative_zero = chunk.add_constant(-0.0)
+    assert zero != negative_zero
+    assert chunk.add_constant(-0.0) == negative_zero
+    assert math.copysign(1.0, chunk.constants[negative_zero]) < 0.0
+    assert math.copysign(1.0, chunk.constants[zero]) > 0.0
+
+
+def test_nan_and_inf():
+    chunk = Chunk()
+    inf = chunk.add_constant(float("inf"))
+    assert chunk.add_constant(float("inf")) == inf
+    assert chunk.add_constant(float("-inf")) != inf
+    nan = chunk.add_constant(float("nan"))
+    assert math.isnan(chunk.constants[nan])
+
+
+def test_truncate_constants():
+    chunk = Chunk()
+    chunk.add_constant(1.0)
+    chunk.add_constant(0.0)
+    chunk.add_constant(-0.0)
+    chunk.add_constant(2.0)
+    chunk.truncate_constants(1)
+    assert chunk.constants == [1.0]
+    assert chunk.add_constant(1.0) == 0
+    assert chunk.add_constant(2.0) == 1
+    assert chunk.add_constant(-0.0) == 2
+    assert chunk.add_constant(0.0) == 3
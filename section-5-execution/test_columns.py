@@ -0,0 +1,72 @@
+import struct
+
+import pytest
+
+import columns
+from columns import ColumnError, CsvRows, RawColumns, Rows
+from reader import MappedFile
+
+
+def read_all(rows):
+    values = [0.0] * len(rows.names)
+    result = []
+    while rows.next_row(values):
+        result.append(list(values))
+    return result
+
+
+def mapped(tmpdir, data):
+    path = tmpdir.join("rows")
+    path.write(data, mode="wb")
+    return MappedFile(str(path))
+
+
+def test_rows():
+    rows = Rows(["x", "y"], [[1.0, 2.0], [-3.0, 4.0]])
+    assert read_all(rows) == [[1.0, -3.0], [2.0, 4.0]]
+
+
+def test_csv(tmpdir):
+    rows = CsvRows(mapped(tmpdir, "a, b\n1,-2\n\n3, 4.5\n-0.25,1e3"))
+    assert rows.names == ["a", "b"]
+    assert read_all(rows) == [[1.0, -2.0], [3.0, 4.5], [-0.25, 1000.0]]
+
+
+def test_csv_errors(tmpdir):
+    with pytest.raises(ColumnError):
+        CsvRows(mapped(tmpdir, "\n\n"))
+    with pytest.raises(ColumnError):
+        read_all(CsvRows(mapped(tmpdir, "a,b\n1\n")))
+    with pytest.raises(ColumnError):
+        read_all(CsvRows(mapped(tmpdir, "a,b\n1,x\n")))
+
+
+@pytest.fixture
+def small_blocks(monkeypatch):
+    monkeypatch.setattr(columns, "BLOCK_ROWS", 4)
+
+
+def test_csv_across_blocks(tmpdir, small_blocks):
+    lines = ["%d,%d" % (i, -i) for i in range(11)]
+    rows = CsvRows(mapped(tmpdir, "a,b\n" + "\n".join(lines)))
+    assert read_all(rows) == [[i, -i] for i in range(11)]
+
+
+def test_raw_across_blocks(tmpdir, small_blocks):
+    count = 11
+    a = [i - count / 2.0 for i in range(count)]
+    b = [-x * 1e300 for x in a]
+    data = struct.pack("<%dd" % (2 * count), *(a + b))
+    rows = RawColumns(mapped(tmpdir, data), ["a", "b"])
+    assert read_all(rows) == [[a[i], b[i]] for i in range(count)]
+
+
+def test_raw_empty(tmpdir):
+    rows = RawColumns(mapped(tmpdir, ""), ["a", "b"])
+    assert read_all(rows) == []
+    assert read_all(rows) == []
+
+
+def test_raw_size(tmpdir):
+    with pytest.raises(ColumnError):
+        RawColumns(mapped(tmpdir, "\x00" * 12), ["a"])
@@ -0,0 +1,58 @@
+import random
+
+import pytest
+
+from compiler import Compiler
+
+
+def compile_source(capsys, source, **options):
+    compiler = Compiler(source, debugging=False, **options)
+    ok = compiler.compile()
+    out, err = capsys.readouterr()
+    return ok, out, compiler.chunk.code
+
+
+def random_sources(seed, count):
+    pieces = ["1", "2.5", "(", ")", "-", "+", "*", "/", " ", "$", "x"]
+    rng = random.Random(seed)
+    for i in range(count):
+        yield "".join(rng.choice(pieces)
+                      for j in range(rng.randint(1, 10)))
+
+
+@pytest.mark.parametrize("source", [
+    "+-/", ")/", "1 + * 2", "(", "((1)", "-", "1 2", "(1 + ) * 3",
+])
+def test_iterative_errors_match(capsys, source):
+    recursive = compile_source(capsys, source)
+    assert not recursive[0]
+    assert compile_source(capsys, source, iterative=True) == recursive
+
+
+@pytest.mark.parametrize("fold_constants", [False, True])
+def test_iterative_matches_recursive(capsys, fold_constants):
+    for source in random_sources(1, 1000):
+        recursive = compile_source(capsys, source,
+                                   fold_constants=fold_constants)
+        iterative = compile_source(capsys, source, iterative=True,
+                                   fold_constants=fold_constants)
+        assert iterative == recursive, source
+
+
+class Output(object):
+    def __init__(self):
+        self.parts = []
+
+    def write(self, text):
+        self.parts.append(text)
+
+
+def test_errors_to_output(capsys):
+    for source in random_sources(2, 200):
+        printed = compile_source(capsys, source)
+        output = Output()
+        compiler = Compiler(source, debugging=False, output=output)
+        compiler.compile()
+        out, err = capsys.readouterr()
+        assert out == ""
+        assert "".join(output.parts) == printed[1], source
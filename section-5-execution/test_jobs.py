@@ -0,0 +1,69 @@
+import os
+
+from jobs import ReorderBuffer, WorkerOutput
+
+
+class Output(object):
+    def __init__(self):
+        self.parts = []
+
+    def write(self, data):
+        self.parts.append(data)
+
+
+def batches(worker):
+    return zip(worker.batches, worker.line_counts)
+
+
+def test_feed_in_one_read():
+    worker = WorkerOutput(0, -1)
+    worker.feed("1.0\n2.0\n#2\n3.0\n#1\n")
+    assert batches(worker) == [("1.0\n2.0\n", 2), ("3.0\n", 1)]
+    assert not worker.incomplete()
+
+
+def test_feed_split_anywhere():
+    data = "1.0\n2.0\n#12\n#0\n3.0\n#1\n"
+    for split in range(len(data) + 1):
+        for second in range(split, len(data) + 1):
+            worker = WorkerOutput(0, -1)
+            worker.feed(data[:split])
+            worker.feed(data[split:second])
+            worker.feed(data[second:])
+            assert batches(worker) == [("1.0\n2.0\n", 12), ("", 0),
+                                       ("3.0\n", 1)]
+            assert not worker.incomplete()
+
+
+def test_feed_incomplete():
+    worker = WorkerOutput(0, -1)
+    worker.feed("1.0\n")
+    assert worker.incomplete()
+    worker = WorkerOutput(0, -1)
+    worker.feed("1.0\n#3")
+    assert worker.incomplete()
+    assert worker.batches == []
+
+
+def run_workers(outputs):
+    workers = []
+    for data in outputs:
+        read_fd, write_fd = os.pipe()
+        os.write(write_fd, data)
+        os.close(write_fd)
+        workers.append(WorkerOutput(0, read_fd))
+    output = Output()
+    reorder = ReorderBuffer(workers, output)
+    return reorder.run(), "".join(output.parts), reorder.lines
+
+
+def test_reorder_in_batch_order():
+    # Batch i comes from worker i % 3
+    outputs = ["b0\n#1\nb3\n#1\n", "b1\n#1\nb4\nb4\n#2\n", "b2\n#1\n"]
+    assert run_workers(outputs) == (True, "b0\nb1\nb2\nb3\nb4\nb4\n", 6)
+
+
+def test_reorder_worker_stopped_early():
+    ok, text, lines = run_workers(["b0\n#1\n", "b1\n"])
+    assert not ok
+    assert text == "b0\n"
@@ -0,0 +1,72 @@
+import random
+import struct
+
+import pytest
+
+from output import MAX_EXACT_INTEGER, OutputBuffer, format_float
+
+
+@pytest.mark.parametrize("value", [
+    0.0, -0.0, 1.0, -1.0, 0.1, 0.2, 0.3, 1.0 / 3, 2.0 / 3, 123.456,
+    1e-4, 1e-5, 9.999999999999999e-05, 1e15, 1e16, 1e17, 1e22, 1e300,
+    5e-324, 1.7976931348623157e308,
+    MAX_EXACT_INTEGER - 1, MAX_EXACT_INTEGER, MAX_EXACT_INTEGER + 1,
+    MAX_EXACT_INTEGER + 2,
+    MAX_EXACT_INTEGER - 0.5, 4503599627370495.5,
+    0.30000000000000004, 1.0000000000000002, 0.9999999999999999,
+    2.2250738585072014e-308, 123456789.12345679,
+    float("inf"), float("-inf"),
+])
+def test_format_float_like_repr(value):
+    assert format_float(value) == repr(value)
+    assert format_float(-value) == repr(-value)
+
+
+def test_format_nan():
+    assert format_float(float("nan")) == "nan"
+
+
+def test_format_random_like_repr():
+    rng = random.Random(1)
+    for i in range(1000):
+        if i % 2:
+            # Any bit pattern, most of which need 17 digits
+            value = struct.unpack("<d", struct.pack(
+                "<Q", rng.getrandbits(64)))[0]
+        else:
+            # Around the range formatted in fixed point
+            value = rng.uniform(-1.0, 1.0) * 10.0 ** rng.randint(-6, 17)
+        if value == value:
+            assert format_float(value) == repr(value)
+
+
+class Output(object):
+    def __init__(self):
+        self.writes = []
+
+    def write(self, text):
+        self.writes.append(text)
+
+    def flush(self):
+        pass
+
+
+def test_output_buffer():
+    output = Output()
+    buffer = OutputBuffer(output, size=8)
+    buffer.write("1.0\n")
+    assert output.writes == []
+    buffer.write("2.0\n")
+    assert output.writes == ["1.0\n2.0\n"]
+    buffer.write("3")
+    buffer.flush()
+    assert output.writes == ["1.0\n2.0\n", "3"]
+
+
+def test_output_buffer_line_buffered():
+    output = Output()
+    buffer = OutputBuffer(output, line_buffered=True)
+    buffer.write("> ")
+    assert output.writes == []
+    buffer.write("1.0\n")
+    assert output.writes == ["> 1.0\n"]
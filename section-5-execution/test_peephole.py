@@ -0,0 +1,60 @@
+import pytest
+
+from opcodes import OpCode
+from peephole import optimize_chunk
+from test_vm import (compile_chunk, random_expressions, random_rows, run,
+                     same_float)
+
+
+def sources():
+    # Negations and identity operands are what the optimizer rewrites, so
+    # make sure there are plenty of them
+    identities = ["a * 1", "a / 1", "a + -0", "a + (-0.0)", "a - 0",
+                  "a - 0.0", "a - -0", "a - (-0.0)", "--a", "-(-a)",
+                  "a + 0", "0 - a", "-0 + a", "-(1)", "-0 * a", "1 * a",
+                  "a * -1", "a / -1", "-0 - 0", "-0.0 + -0",
+                  "(0 / 0) * 1", "-(0 / 0) - 0", "--(a / 1) + -0"]
+    return identities + ["(%s) * 1 - 0 + --b" % source
+                         for source in random_expressions(6, 200)]
+
+
+NAN = float("nan")
+INF = float("inf")
+
+
+@pytest.mark.parametrize("superinstructions", [False, True])
+@pytest.mark.parametrize("fold_constants", [False, True])
+def test_optimized_chunks_agree(superinstructions, fold_constants):
+    rows = random_rows(7, 3) + [[-0.0, 0.0, -0.0], [0.0, -0.0, 0.0],
+                                [NAN, -0.0, NAN], [-INF, NAN, INF]]
+    for source in sources():
+        # Compare with the chunk compiled without any optimization
+        chunk = compile_chunk(source)
+        optimized = compile_chunk(source, fold_constants=fold_constants)
+        optimize_chunk(optimized, superinstructions)
+        assert len(optimized.code) <= len(chunk.code)
+        assert (optimized.max_stack_depth ==
+                optimized.compute_max_stack_depth())
+        for row in rows:
+            assert same_float(run(optimized, row), run(chunk, row)), \
+                (source, row)
+
+
+def test_removes_identities():
+    chunk = compile_chunk("--(a * 1 / 1) - 0")
+    assert optimize_chunk(chunk) == 8
+    assert [chunk.get_code(i) for i in range(len(chunk.code))] == [
+        OpCode.OP_LOAD_VAR, 0, OpCode.OP_RETURN]
+
+
+def test_keeps_adding_zero():
+    # -0.0 + 0.0 is 0.0, so this isn't an identity
+    chunk = compile_chunk("a + 0")
+    assert optimize_chunk(chunk) == 0
+    assert same_float(run(chunk, [-0.0, 0.0, 0.0]), 0.0)
+
+
+def test_drops_unused_constants():
+    chunk = compile_chunk("a * 1 + 2")
+    optimize_chunk(chunk)
+    assert chunk.constants == [2.0]
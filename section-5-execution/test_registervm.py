@@ -0,0 +1,35 @@
+from registervm import MAX_REGISTERS, RegisterCompiler
+from test_vm import (compile_chunk, random_expressions, random_rows, run,
+                     same_float)
+
+
+def test_registers_agree():
+    rows = random_rows(2, 3)
+    for source in random_expressions(1, 300):
+        for superinstructions in [False, True]:
+            chunk = compile_chunk(source,
+                                  superinstructions=superinstructions)
+            for row in rows:
+                assert same_float(run(chunk, row, registers=True),
+                                  run(chunk, row)), source
+
+
+def test_constants_stay_out_of_registers():
+    code = RegisterCompiler(compile_chunk("a * 2 + 3")).compile()
+    # OP_LOAD_VAR, OP_MULTIPLY_K, OP_ADD_K and OP_RETURN
+    assert code.instruction_count == 4
+    assert code.register_count == 1
+
+
+def test_too_many_registers():
+    chunk = compile_chunk("a + " * MAX_REGISTERS + "a")
+    assert RegisterCompiler(chunk).compile() is not None
+    # Each level of nesting keeps one more value on the stack
+    chunk = compile_chunk("a + (" * MAX_REGISTERS + "a" + ")" * MAX_REGISTERS,
+                          iterative=True)
+    assert RegisterCompiler(chunk).compile() is None
+    # It's run on the stack instead, and only translated the once
+    row = [1.0, 2.0, 3.0]
+    assert run(chunk, row, registers=True) == run(chunk, row)
+    assert chunk.register_failed
+    assert chunk.register_code is None
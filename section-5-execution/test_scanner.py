@@ -0,0 +1,85 @@
+import random
+from StringIO import StringIO
+
+import pytest
+
+from reader import LineReader
+from scanner import Scanner, StreamScanner, Token, TokenTypes
+
+
+def scan_tokens(scanner):
+    tokens = []
+    while True:
+        token = scanner.scan_token()
+        tokens.append(describe(scanner, token))
+        if token.type == TokenTypes.EOF:
+            return tokens
+
+
+def describe(scanner, token):
+    if token.type == TokenTypes.ERROR:
+        return (token.type, token.start, token.message)
+    if token.type == TokenTypes.NUMBER:
+        return (token.type, token.start, token.length, token.value)
+    if token.type == TokenTypes.IDENTIFIER:
+        return (token.type, token.start, token.length, token.name)
+    return (token.type, token.start, token.length)
+
+
+def scan_stream(source):
+    stream = Scanner(source).scan_all()
+    tokens = []
+    token = Token(0, 0, TokenTypes.EOF)
+    numbers = iter(stream.values)
+    names = iter(stream.names)
+    for i in range(stream.size()):
+        stream.load(i, token)
+        if token.type == TokenTypes.ERROR:
+            tokens.append((token.type, token.start, stream.get_message(i)))
+        elif token.type == TokenTypes.NUMBER:
+            tokens.append((token.type, token.start, token.length,
+                           next(numbers)))
+        elif token.type == TokenTypes.IDENTIFIER:
+            tokens.append((token.type, token.start, token.length,
+                           next(names)))
+        else:
+            tokens.append((token.type, token.start, token.length))
+    return tokens
+
+
+def random_sources(seed, count):
+    pieces = ["1", "23", "4.5", "0.125", "6.", ".", "(", ")", "-", "+",
+              "*", "/", " ", "\t", "$", "x", "price", "_a1", "1e3"]
+    rng = random.Random(seed)
+    for i in range(count):
+        yield "".join(rng.choice(pieces) for j in range(rng.randint(0, 30)))
+
+
+@pytest.mark.parametrize("source", [
+    "", "1 + 2", "3.25 * (4 - -5)", "12$3", "1.", "x_1 * price",
+    "0.1 + 0.2", "123456789.987654321",
+])
+def test_scan_all_matches_scan_token(source):
+    assert scan_stream(source) == scan_tokens(Scanner(source))
+
+
+def test_scan_all_matches_scan_token_random():
+    for source in random_sources(1, 500):
+        assert scan_stream(source) == scan_tokens(Scanner(source)), source
+
+
+@pytest.mark.parametrize("block_size", [1, 2, 3, 7, 64])
+def test_stream_scanner_matches(block_size):
+    for source in random_sources(2, 300):
+        reader = LineReader(StringIO(source + "\n"), block_size)
+        tokens = scan_tokens(StreamScanner(reader))
+        assert tokens == scan_tokens(Scanner(source)), source
+
+
+def test_partial_source():
+    source = "ignored 1 + 2 ignored"
+    tokens = scan_tokens(Scanner(source, 8, 13))
+    assert [token[0] for token in tokens] == [
+        TokenTypes.NUMBER, TokenTypes.PLUS, TokenTypes.NUMBER,
+        TokenTypes.EOF]
+    assert tokens[0][1] == 0
@@ -0,0 +1,112 @@
+import errno
+
+import pytest
+from rpython.rlib.rsocket import (AF_UNIX, SO_RCVBUF, SO_SNDBUF, SOL_SOCKET,
+                                  CSocketError, socketpair)
+
+import server
+from server import Connection, decode_length, encode_length
+
+WOULD_BLOCK = (errno.EAGAIN, errno.EWOULDBLOCK)
+
+
+@pytest.fixture(autouse=True)
+def small_reads(monkeypatch):
+    # Untranslated, a read costs time in proportion to its buffer size
+    monkeypatch.setattr(server, "READ_SIZE", 1024)
+
+
+class Echo(object):
+    def evaluate(self, source):
+        return "=" + source
+
+
+def request(source):
+    return encode_length(len(source)) + source
+
+
+def responses(data):
+    result = []
+    pos = 0
+    while len(data) - pos >= 4:
+        length = decode_length(data, pos)
+        result.append(data[pos + 4:pos + 4 + length])
+        pos += 4 + length
+    assert pos == len(data)
+    return result
+
+
+def test_length_round_trip():
+    for length in [0, 1, 255, 256, 65536, 2**24 + 3]:
+        assert decode_length(encode_length(length), 0) == length
+
+
+def test_requests_split_across_reads():
+    client, server = socketpair(AF_UNIX)
+    connection = Connection(server)
+    data = request("1 + 2") + request("") + request("3")
+    for i in range(len(data)):
+        client.sendall(data[i])
+        connection.read(Echo())
+    assert not connection.closed
+    assert responses(client.recv(1000)) == ["=1 + 2", "=", "=3"]
+
+
+def test_pipelined_requests_fill_the_send_buffer():
+    # The responses to requests sent before any are read soon fill the
+    # small socket buffers. The rest must wait to be sent rather than the
+    # connection being closed.
+    client, server_sock = socketpair(AF_UNIX)
+    server_sock.setsockopt_int(SOL_SOCKET, SO_SNDBUF, 4096)
+    client.setsockopt_int(SOL_SOCKET, SO_RCVBUF, 4096)
+    server_sock.setblocking(False)
+    client.setblocking(False)
+    connection = Connection(server_sock)
+    source = "x" * 200
+    count = 200
+    unsent = request(source) * count
+    expected = len(encode_length(0) + "=" + source) * count
+    received = []
+    size = 0
+    backed_up = False
+    steps = 0
+    while size < expected:
+        if unsent:
+            try:
+                unsent = unsent[client.send(unsent):]
+            except CSocketError as e:
+                assert e.errno in WOULD_BLOCK
+        connection.read(Echo())
+        if connection.unsent:
+            connection.send()
+        assert not connection.closed
+        # Only start reading the responses once they have backed up
+        backed_up = backed_up or len(connection.unsent) > 0
+        if not backed_up:
+            steps += 1
+            assert steps < 10000
+            continue
+        try:
+            data = client.recv(2**12)
+        except CSocketError as e:
+            assert e.errno in WOULD_BLOCK
+        else:
+            received.append(data)
+            size += len(data)
+    assert responses("".join(received)) == ["=" + source] * count
+
+
+def test_closed_by_client():
+    client, server = socketpair(AF_UNIX)
+    connection = Connection(server)
+    client.close()
+    connection.read(Echo())
+    assert connection.closed
+
+
+def test_oversized_request():
+    client, server = socketpair(AF_UNIX)
+    connection = Connection(server)
+    client.sendall(encode_length(2**30))
+    connection.read(Echo())
+    assert connection.closed
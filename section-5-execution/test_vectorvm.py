@@ -0,0 +1,35 @@
+from test_vm import (compile_chunk, random_expressions, random_rows, run,
+                     same_float, NAMES)
+from vectorvm import VectorVM
+
+import pytest
+
+
+@pytest.mark.parametrize("block_size", [1, 3, 64])
+def test_vector_vm_agrees(block_size):
+    rows = random_rows(3, 10)
+    columns = [[row[i] for row in rows] for i in range(len(NAMES))]
+    vm = VectorVM(block_size)
+    for source in random_expressions(4, 200):
+        chunk = compile_chunk(source, superinstructions=True)
+        expected = [run(chunk, row) for row in rows]
+        if None in expected:
+            # Untranslated, dividing by zero raises rather than giving inf
+            continue
+        start = 0
+        while start < len(rows):
+            count = min(block_size, len(rows) - start)
+            results = vm.run(chunk, columns, start, count)
+            assert results is not None
+            for i in range(count):
+                assert same_float(results[i], expected[start + i]), source
+            start += count
+
+
+def test_vector_vm_rejects_bad_input():
+    chunk = compile_chunk("a + b")
+    vm = VectorVM(4)
+    assert vm.run(chunk, [[1.0] * 4, [2.0] * 4], 0, 5) is None
+    assert vm.run(chunk, [[1.0] * 4], 0, 4) is None
+    assert vm.run(chunk, [[1.0] * 4, [2.0] * 2], 1, 2) is None
+    assert list(vm.run(chunk, [[1.0] * 4, [2.0] * 4], 1, 3)[:3]) == [3.0] * 3
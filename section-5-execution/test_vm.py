@@ -0,0 +1,138 @@
+import math
+import random
+
+import pytest
+
+from columns import ColumnError, Rows
+from compiler import Compiler
+from output import LastResult
+from pairs import OpcodePairs
+from vm import VM, InterpretResultCode
+
+NAMES = ["a", "b", "c"]
+
+
+def random_expression(rng, depth):
+    if depth == 0 or rng.random() < 0.2:
+        return rng.choice(["0", "1", "2", "0.5", "3.25", "a", "b", "c"])
+    choice = rng.random()
+    if choice < 0.15:
+        return "-" + random_expression(rng, depth - 1)
+    if choice < 0.3:
+        return "(%s)" % random_expression(rng, depth - 1)
+    return "%s %s %s" % (random_expression(rng, depth - 1),
+                         rng.choice("+-*/"),
+                         random_expression(rng, depth - 1))
+
+
+def random_expressions(seed, count):
+    rng = random.Random(seed)
+    return [random_expression(rng, 5) for i in range(count)]
+
+
+def random_rows(seed, count):
+    rng = random.Random(seed)
+    return [[rng.choice([-2.5, -1.0, 0.5, 1.0, 3.0, 7.25])
+             for name in NAMES] for i in range(count)]
+
+
+def compile_chunk(source, **options):
+    compiler = Compiler(source, debugging=False, variables=NAMES, **options)
+    assert compiler.compile()
+    return compiler.chunk
+
+
+def run(chunk, row, **options):
+    """
+    The result of running chunk on row, or None for a runtime error.
+    """
+    sink = LastResult()
+    vm = VM(debug=False, sink=sink, **options)
+    vm.variables = list(row)
+    if vm.interpret_chunk(chunk) != InterpretResultCode.INTERPRET_OK:
+        return None
+    return sink.value
+
+
+def same_float(a, b):
+    if a is None or b is None:
+        return a is b
+    if math.isnan(a):
+        return math.isnan(b)
+    return a == b and math.copysign(1.0, a) == math.copysign(1.0, b)
+
+
+@pytest.mark.parametrize("options", [
+    {"cache_top": True},
+    {"pairs": OpcodePairs()},
+])
+def test_run_loops_agree(options):
+    rows = random_rows(2, 3)
+    for source in random_expressions(1, 200):
+        for superinstructions in [False, True]:
+            chunk = compile_chunk(source,
+                                  superinstructions=superinstructions)
+            for row in rows:
+                expected = run(chunk, row)
+                assert same_float(run(chunk, row, **options), expected), \
+                    source
+
+
+class Results(LastResult):
+    def __init__(self):
+        LastResult.__init__(self)
+        self.values = []
+
+    def write_result(self, value):
+        self.values.append(value)
+
+
+@pytest.mark.parametrize("options", [{}, {"cache_top": True},
+                                     {"registers": True}])
+def test_interpret_rows(options):
+    rows = random_rows(5, 20)
+    columns = [[row[i] for row in rows] for i in range(len(NAMES))]
+    chunk = compile_chunk("a * b - c / 2")
+    sink = Results()
+    vm = VM(debug=False, sink=sink, **options)
+    vm.variables = [0.0] * len(NAMES)
+    assert (vm.interpret_rows(chunk, Rows(NAMES, columns)) ==
+            InterpretResultCode.INTERPRET_OK)
+    assert vm.rows_run == len(rows)
+    assert sink.values == [run(chunk, row) for row in rows]
+
+
+def test_interpret_rows_stops_at_error():
+    chunk = compile_chunk("a / b")
+    vm = VM(debug=False, sink=Results())
+    vm.variables = [0.0] * len(NAMES)
+    rows = Rows(NAMES, [[1.0, 2.0, 3.0], [1.0, 0.0, 1.0], [0.0] * 3])
+    assert (vm.interpret_rows(chunk, rows) ==
+            InterpretResultCode.INTERPRET_RUNTIME_ERROR)
+    assert vm.rows_run == 1
+
+
+class BadRows(Rows):
+    def _read_block(self):
+        raise ColumnError("bad row")
+
+
+def test_interpret_rows_raises_column_errors():
+    vm = VM(debug=False, sink=Results())
+    vm.variables = [0.0] * len(NAMES)
+    with pytest.raises(ColumnError):
+        vm.interpret_rows(compile_chunk("a"),
+                          BadRows(NAMES, [[1.0], [2.0], [3.0]]))
+    assert vm.rows is None
+
+
+def test_stack_size_depends_only_on_chunk():
+    # The JIT needs the same stack length every time a chunk is run
+    deep = compile_chunk("a + (" * 300 + "a" + ")" * 300, iterative=True)
+    shallow = compile_chunk("a + b")
+    vm = VM(debug=False, sink=Results())
+    vm.variables = [1.0, 2.0, 3.0]
+    for chunk in [shallow, deep, shallow, deep]:
+        assert vm.interpret_chunk(chunk) == InterpretResultCode.INTERPRET_OK
+        assert len(vm.stack) == max(VM.STACK_MAX_SIZE, chunk.max_stack_depth)
+    assert vm.sink.values == [3.0, 301.0, 3.0, 301.0]
@@ -0,0 +1,144 @@
+"""
+A VM that runs a chunk over a block of rows at once. Each stack slot
+holds a block of values, a value per row, and each instruction is
+applied to the whole block before the next is dispatched, so the cost
+of dispatch is shared by every row in the block.
+"""
+from opcodes import OpCode
+from rpython.rlib.debug import make_sure_not_resized
+from rpython.rlib.objectmodel import specialize
+
+
+@specialize.arg(3)
+def _elementwise(a, b, count, operator):
+    for i in range(count):
+        a[i] = operator(a[i], b[i])
+
+
+@specialize.arg(3)
+def _with_constant(a, constant, count, operator):
+    for i in range(count):
+        a[i] = operator(a[i], constant)
+
+
+def _add(op1, op2):
+    return op1 + op2
+
+
+def _subtract(op1, op2):
+    return op1 - op2
+
+
+def _multiply(op1, op2):
+    return op1 * op2
+
+
+def _divide(op1, op2):
+    return op1 / op2
+
+
+class VectorVM(object):
+
+    def __init__(self, block_size):
+        self.block_size = block_size
+        # A block per stack slot, added as chunks need them
+        self.stack = []
+
+    def _new_block(self):
+        block = [0.0] * self.block_size
+        make_sure_not_resized(block)
+        return block
+
+    def run(self, chunk, columns, start, count):
+        """
+        Evaluate chunk for `count` rows, where variable slot i of row r has
+        the value columns[i][start + r]. Returns a block holding the
+        results of the rows, which is reused by the next run, or None if
+        the chunk can't be run.
+        """
+        if count > self.block_size:
+            return None
+        if chunk.max_stack_depth < 0:
+            chunk.max_stack_depth = chunk.compute_max_stack_depth()
+            if chunk.max_stack_depth < 0:
+                return None
+        if chunk.variable_count > len(columns):
+            return None
+        for column in columns:
+            if start + count > len(column):
+                return None
+        while len(self.stack) < chunk.max_stack_depth:
+            self.stack.append(self._new_block())
+        try:
+            return self._run(chunk, columns, start, count)
+        except:
+            return None
+
+    @staticmethod
+    def _constant(chunk, ip):
+        return chunk.get_constant(chunk.get_code(ip))
+
+    def _run(self, chunk, columns, start, count):
+        stack = self.stack
+        top = 0
+        ip = 0
+        while True:
+            instruction = chunk.get_code(ip)
+            ip += 1
+            # RPython turns this chain of comparisons into a C switch
+            if instruction == OpCode.OP_CONSTANT:
+                constant = self._constant(chunk, ip)
+                ip += 1
+                block = stack[top]
+                for i in range(count):
+                    block[i] = constant
+                top += 1
+            elif instruction == OpCode.OP_CONSTANT_LONG:
+                constant = chunk.get_constant(
+                    chunk.read_constant_index(ip - 1))
+                ip += 3
+                block = stack[top]
+                for i in range(count):
+                    block[i] = constant
+                top += 1
+            elif instruction == OpCode.OP_LOAD_VAR:
+                column = columns[chunk.get_code(ip)]
+                ip += 1
+                block = stack[top]
+                for i in range(count):
+                    block[i] = column[start + i]
+                top += 1
+            elif instruction == OpCode.OP_NEGATE:
+                block = stack[top - 1]
+                for i in range(count):
+                    block[i] = block[i] * -1
+            elif instruction == OpCode.OP_ADD:
+                top -= 1
+                _elementwise(stack[top - 1], stack[top], count, _add)
+            elif instruction == OpCode.OP_SUBTRACT:
+                top -= 1
+                _elementwise(stack[top - 1], stack[top], count, _subtract)
+            elif instruction == OpCode.OP_MULTIPLY:
+                top -= 1
+                _elementwise(stack[top - 1], stack[top], count, _multiply)
+            elif instruction == OpCode.OP_DIVIDE:
+                top -= 1
+                _elementwise(stack[top - 1], stack[top], count, _divide)
+            elif instruction == OpCode.OP_ADD_CONST:
+                _with_constant(stack[top - 1], self._constant(chunk, ip),
+                               count, _add)
+                ip += 1
+            elif instruction == OpCode.OP_SUBTRACT_CONST:
+                _with_constant(stack[top - 1], self._constant(chunk, ip),
+                               count, _subtract)
+                ip += 1
+            elif instruction == OpCode.OP_MULTIPLY_CONST:
+                _with_constant(stack[top - 1], self._constant(chunk, ip),
+                               count, _multiply)
+                ip += 1
+            elif instruction == OpCode.OP_DIVIDE_CONST:
+                _with_constant(stack[top - 1], self._constant(chunk, ip),
+                               count, _divide)
+                ip += 1
+            elif instruction == OpCode.OP_RETURN:
+                return stack[top - 1]
@@ -1,5 +1,11 @@
+from columns import ColumnError
 from opcodes import OpCode
-from debug import disassemble_instruction, get_printable_location
+from output import format_float
+from registervm import RegisterCompiler, RegisterVM
+from debug import (disassemble_instruction, get_printable_location,
+                   OpCodeToInstructionName)
+from rpython.rlib import jit
+from rpython.rlib.debug import make_sure_not_resized
 from rpython.rlib.objectmodel import specialize
 
 class InterpretResultCode:
@@ -12,9 +18,32 @@ IntepretResultToName = {getattr(InterpretResultCode, op): op
                         for op in dir(InterpretResultCode) if op.startswith('INTERPRET_')}
 
 
+# The instruction pointer and the chunk being executed identify a position in
+# the user's program so they are green. Everything else lives on the VM which
+# is virtualizable, letting the JIT keep the operand stack in registers.
+# Being green, the chunk is a constant in every trace already, and as its
+# code and constants are immutable and read through elidable getters they
+# fold to constants too, so nothing needs promoting.
+jitdriver = jit.JitDriver(
+    greens=['ip', 'chunk'],
+    reds=['vm'],
+    virtualizables=['vm'],
+    get_printable_location=get_printable_location,
+)
+
+
 class VM(object):
+    _virtualizable_ = ['ip', 'chunk', 'stack_top', 'stack[*]']
+    _immutable_fields_ = ['debug_trace', 'sink', 'pairs', 'cache_top',
+                          'register_vm']
+
+    # The size of the stack, unless a chunk needs it larger
     STACK_MAX_SIZE = 256
 
+    # Dispatch through the opcode indexed handler table rather than the
+    # if/elif chain. Fixed at translation time, see select_dispatch.
+    DISPATCH_TABLE = False
+
     chunk = None
     stack = None
     stack_top = 0
@@ -23,23 +52,60 @@ class VM(object):
     # points to the next instruction to be executed
     ip = 0
 
-    def __init__(self, debug=True):
+    def __init__(self, debug=False, sink=None, pairs=None, cache_top=False,
+                 registers=False):
         self.debug_trace = debug
+        # Results go to a ResultSink if one is given, and are printed
+        # otherwise.
+        self.sink = sink
+        # Executed instruction pairs are counted into an OpcodePairs if
+        # one is given
+        self.pairs = pairs
+        # The values of the variables, by slot
+        self.variables = []
+        # Run with _run_top_cached rather than _run
+        self.cache_top = cache_top
+        # Run chunks translated to register code, on a RegisterVM
+        self.register_vm = None
+        if registers:
+            self.register_vm = RegisterVM()
+        # The rows interpret_rows is running the chunk over, the number run
+        # to completion and any ColumnError reading them
+        self.rows = None
+        self.rows_run = 0
+        self.row_error = None
         self._reset_stack()
 
     def _reset_stack(self):
-        self.stack = [0] * self.STACK_MAX_SIZE
+        # Every value our language has is a float, so the stack is a fixed
+        # size array of unboxed floats that is allocated once and reused.
+        # There is deliberately no typed representation for other kinds of
+        # value yet: a stack of boxed values would allocate on every push,
+        # and a tag per slot would be checked by every instruction, for
+        # values that can't occur. Whichever the first non-float value
+        # needs, it should come with that value.
+        self._allocate_stack(self.STACK_MAX_SIZE)
+
+    def _allocate_stack(self, size):
+        self.stack = [0.0] * size
+        make_sure_not_resized(self.stack)
         self.stack_top = 0
 
     def _stack_push(self, value):
-        assert self.stack_top < self.STACK_MAX_SIZE
-        self.stack[self.stack_top] = value
-        self.stack_top += 1
+        # Chunks are verified before they are run, so the stack is always
+        # big enough and pops never underflow. The asserts only tell RPython
+        # the index is never negative, which the JIT needs to virtualize
+        # the stack.
+        stack_top = self.stack_top
+        assert stack_top >= 0
+        self.stack[stack_top] = value
+        self.stack_top = stack_top + 1
 
     def _stack_pop(self):
-        assert self.stack_top >= 0
-        self.stack_top -= 1
-        return self.stack[self.stack_top]
+        stack_top = self.stack_top - 1
+        assert stack_top >= 0
+        self.stack_top = stack_top
+        return self.stack[stack_top]
 
     def _print_stack(self):
         print "         ",
@@ -51,31 +117,261 @@ class VM(object):
         print
 
     def _run(self):
+        # The fast path, and the JIT's portal. Nothing here may depend on
+        # self.debug_trace; tracing has its own loop in _run_traced.
         while True:
-            if self.debug_trace:
-                self._print_stack()
-                disassemble_instruction(self.chunk, self.ip)
-            instruction = self._read_byte()
+            jitdriver.jit_merge_point(ip=self.ip, chunk=self.chunk, vm=self)
+            if self._execute(self._read_byte()):
+                if self.rows is None:
+                    return InterpretResultCode.INTERPRET_OK
+                self.rows_run += 1
+                if not self._next_row():
+                    return InterpretResultCode.INTERPRET_OK
+                # Chunks are straight line code, so running the chunk again
+                # for the next row is the only jump back, and the only place
+                # a loop can start. A chunk run once is only ever traced by
+                # counting entries to the portal, and a batch of different
+                # chunks never loops.
+                self.ip = 0
+                self.stack_top = 0
+                jitdriver.can_enter_jit(ip=self.ip, chunk=self.chunk,
+                                        vm=self)
 
-            if instruction == OpCode.OP_RETURN:
-                print "%s" % self._stack_pop()
-                return InterpretResultCode.INTERPRET_OK
-            elif instruction == OpCode.OP_CONSTANT:
-                constant = self._read_constant()
-                self._stack_push(constant)
+    def _next_row(self):
+        """
+        Read the next row into the variables. A ColumnError is kept until
+        the run loop has returned, so it isn't taken for a runtime error.
+        """
+        try:
+            return self.rows.next_row(self.variables)
+        except ColumnError as e:
+            self.row_error = e
+            return False
+
+    def _run_top_cached(self):
+        """
+        The same as _run, with the instruction pointer, the stack size and
+        the value on top of the stack kept in locals rather than on the
+        VM. Only the values below the top are in self.stack, so a binary
+        op reads one value from memory and the top is never stored at
+        all. Not a JIT portal, it's for comparing with _run untranslated
+        and without the JIT.
+        """
+        chunk = self.chunk
+        stack = self.stack
+        ip = 0
+        # The number of values on the stack, the top one being in `top`
+        # and the rest in stack[:size - 1]
+        size = 0
+        top = 0.0
+        while True:
+            instruction = chunk.get_code(ip)
+            ip += 1
+            # RPython turns this chain of comparisons into a C switch
+            if instruction == OpCode.OP_CONSTANT:
+                if size > 0:
+                    spill = size - 1
+                    assert spill >= 0
+                    stack[spill] = top
+                top = chunk.get_constant(chunk.get_code(ip))
+                ip += 1
+                size += 1
+            elif instruction == OpCode.OP_CONSTANT_LONG:
+                if size > 0:
+                    spill = size - 1
+                    assert spill >= 0
+                    stack[spill] = top
+                top = chunk.get_constant(chunk.read_constant_index(ip - 1))
+                ip += 3
+                size += 1
+            elif instruction == OpCode.OP_LOAD_VAR:
+                if size > 0:
+                    spill = size - 1
+                    assert spill >= 0
+                    stack[spill] = top
+                top = self.variables[chunk.get_code(ip)]
+                ip += 1
+                size += 1
             elif instruction == OpCode.OP_NEGATE:
-                operand = self._stack_pop()
-                operand *= -1
-                self._stack_push(operand)
+                top = top * -1
             elif instruction == OpCode.OP_ADD:
-                self._binary_op(self._stack_add)
+                size -= 1
+                below = size - 1
+                assert below >= 0
+                top = stack[below] + top
             elif instruction == OpCode.OP_SUBTRACT:
-                self._binary_op(self._stack_subtract)
+                size -= 1
+                below = size - 1
+                assert below >= 0
+                top = stack[below] - top
             elif instruction == OpCode.OP_MULTIPLY:
-                self._binary_op(self._stack_multiply)
+                size -= 1
+                below = size - 1
+                assert below >= 0
+                top = stack[below] * top
             elif instruction == OpCode.OP_DIVIDE:
-                self._binary_op(self._stack_divide)
+                size -= 1
+                below = size - 1
+                assert below >= 0
+                top = stack[below] / top
+            elif instruction == OpCode.OP_ADD_CONST:
+                top = top + chunk.get_constant(chunk.get_code(ip))
+                ip += 1
+            elif instruction == OpCode.OP_SUBTRACT_CONST:
+                top = top - chunk.get_constant(chunk.get_code(ip))
+                ip += 1
+            elif instruction == OpCode.OP_MULTIPLY_CONST:
+                top = top * chunk.get_constant(chunk.get_code(ip))
+                ip += 1
+            elif instruction == OpCode.OP_DIVIDE_CONST:
+                top = top / chunk.get_constant(chunk.get_code(ip))
+                ip += 1
+            elif instruction == OpCode.OP_RETURN:
+                self.ip = ip
+                self.stack_top = 0
+                self._write_result(top)
+                return InterpretResultCode.INTERPRET_OK
+
+    def _register_code(self):
+        """
+        The chunk translated for the RegisterVM, or None if it can't be,
+        in which case it runs on the stack. Either way the chunk is only
+        translated once.
+        """
+        chunk = self.chunk
+        if chunk.register_code is None and not chunk.register_failed:
+            compiler = RegisterCompiler(chunk)
+            chunk.register_code = compiler.compile()
+            if chunk.register_code is None:
+                chunk.register_failed = True
+                if self.debug_trace:
+                    print "Expression needs too many registers."
+            elif self.debug_trace:
+                chunk.register_code.disassemble("registers")
+                print compiler.report()
+        return chunk.register_code
+
+    def _run_registers(self):
+        chunk = self.chunk
+        self._write_result(self.register_vm.run(chunk.register_code,
+                                                self.variables))
+        return InterpretResultCode.INTERPRET_OK
+
+    def _run_counting_pairs(self):
+        previous = self._read_byte()
+        while not self._execute(previous):
+            instruction = self._read_byte()
+            self.pairs.record(previous, instruction)
+            previous = instruction
+        return InterpretResultCode.INTERPRET_OK
+
+    def _run_traced(self):
+        while True:
+            self._print_stack()
+            disassemble_instruction(self.chunk, self.ip)
+            if self._execute(self._read_byte()):
+                return InterpretResultCode.INTERPRET_OK
+
+    def _execute(self, instruction):
+        """
+        Execute a single instruction, returning True once the chunk
+        has finished.
+        """
+        if self.DISPATCH_TABLE:
+            return dispatch_table[instruction](self)
+        # RPython turns this chain of comparisons into a C switch
+        elif instruction == OpCode.OP_RETURN:
+            return self._op_return()
+        elif instruction == OpCode.OP_CONSTANT:
+            return self._op_constant()
+        elif instruction == OpCode.OP_CONSTANT_LONG:
+            return self._op_constant_long()
+        elif instruction == OpCode.OP_NEGATE:
+            return self._op_negate()
+        elif instruction == OpCode.OP_ADD:
+            return self._op_add()
+        elif instruction == OpCode.OP_SUBTRACT:
+            return self._op_subtract()
+        elif instruction == OpCode.OP_MULTIPLY:
+            return self._op_multiply()
+        elif instruction == OpCode.OP_DIVIDE:
+            return self._op_divide()
+        elif instruction == OpCode.OP_ADD_CONST:
+            return self._op_add_const()
+        elif instruction == OpCode.OP_SUBTRACT_CONST:
+            return self._op_subtract_const()
+        elif instruction == OpCode.OP_MULTIPLY_CONST:
+            return self._op_multiply_const()
+        elif instruction == OpCode.OP_DIVIDE_CONST:
+            return self._op_divide_const()
+        elif instruction == OpCode.OP_LOAD_VAR:
+            return self._op_load_var()
+        return False
+
+    # One handler per opcode, named after the opcode. Each returns True if
+    # execution of the chunk has finished.
+
+    def _op_return(self):
+        self._write_result(self._stack_pop())
+        return True
+
+    def _write_result(self, value):
+        if self.sink is None:
+            print format_float(value)
+        else:
+            self.sink.write_result(value)
+
+    def _op_constant(self):
+        constant = self._read_constant()
+        self._stack_push(constant)
+        return False
+
+    def _op_constant_long(self):
+        constant = self._read_constant_long()
+        self._stack_push(constant)
+        return False
+
+    def _op_load_var(self):
+        self._stack_push(self.variables[self._read_byte()])
+        return False
 
+    def _op_negate(self):
+        operand = self._stack_pop()
+        operand *= -1
+        self._stack_push(operand)
+        return False
+
+    def _op_add(self):
+        self._binary_op(self._stack_add)
+        return False
+
+    def _op_subtract(self):
+        self._binary_op(self._stack_subtract)
+        return False
+
+    def _op_multiply(self):
+        self._binary_op(self._stack_multiply)
+        return False
+
+    def _op_divide(self):
+        self._binary_op(self._stack_divide)
+        return False
+
+    def _op_add_const(self):
+        self._binary_const_op(self._stack_add)
+        return False
+
+    def _op_subtract_const(self):
+        self._binary_const_op(self._stack_subtract)
+        return False
+
+    def _op_multiply_const(self):
+        self._binary_const_op(self._stack_multiply)
+        return False
+
+    def _op_divide_const(self):
+        self._binary_const_op(self._stack_divide)
+        return False
 
     @staticmethod
     def _stack_add(op1, op2):
@@ -93,25 +389,94 @@ class VM(object):
     def _stack_divide(op1, op2):
         return op1 / op2
 
+    def _verify_chunk(self, chunk):
+        """
+        Check the chunk can run, and size the stack for it. Returns False
+        for invalid chunks.
+        """
+        if chunk.max_stack_depth < 0:
+            # Chunks not from the compiler have to be checked first
+            chunk.max_stack_depth = chunk.compute_max_stack_depth()
+            if chunk.max_stack_depth < 0:
+                return False
+        # The JIT takes the length of the virtualizable stack as fixed in a
+        # trace, and reads that many items back when a guard fails, so it
+        # must only depend on the chunk, which is green: the usual size, or
+        # exactly the depth of deeper chunks. The stack is only ever
+        # replaced here, before _run is entered, never while it runs.
+        size = max(self.STACK_MAX_SIZE, chunk.max_stack_depth)
+        if len(self.stack) != size:
+            self._allocate_stack(size)
+        return chunk.variable_count <= len(self.variables)
+
     def interpret_chunk(self, chunk):
         if self.debug_trace:
             print "== VM TRACE =="
+        if not self._verify_chunk(chunk):
+            return InterpretResultCode.INTERPRET_RUNTIME_ERROR
+        self.stack_top = 0
         self.chunk = chunk
         self.ip = 0
         try:
-            result = self._run()
-            return result
+            if (self.register_vm is not None and
+                    self._register_code() is not None):
+                return self._run_registers()
+            if self.debug_trace:
+                return self._run_traced()
+            if self.pairs is not None:
+                return self._run_counting_pairs()
+            if self.cache_top:
+                return self._run_top_cached()
+            return self._run()
         except:
             return InterpretResultCode.INTERPRET_RUNTIME_ERROR
 
+    def interpret_rows(self, chunk, rows):
+        """
+        Run chunk once per row of rows, with the variables, which must
+        have a slot per name, bound to the row's values. Stops at the first
+        row that fails, and rows_run is then the number of rows before it.
+        Raises ColumnError if the rows are malformed.
+        """
+        self.rows_run = 0
+        self.row_error = None
+        if not rows.next_row(self.variables):
+            return InterpretResultCode.INTERPRET_OK
+        if (self.register_vm is not None or self.debug_trace or
+                self.pairs is not None or self.cache_top):
+            # Only _run loops over the rows itself
+            while True:
+                result = self.interpret_chunk(chunk)
+                if result != InterpretResultCode.INTERPRET_OK:
+                    return result
+                self.rows_run += 1
+                if not rows.next_row(self.variables):
+                    return result
+        self.rows = rows
+        try:
+            result = self.interpret_chunk(chunk)
+        finally:
+            self.rows = None
+        if self.row_error is not None:
+            error = self.row_error
+            self.row_error = None
+            raise error
+        return result
+
     def _read_byte(self):
-        instruction = self.chunk.code[self.ip]
+        instruction = self.chunk.get_code(self.ip)
         self.ip += 1
         return instruction
 
     def _read_constant(self):
         constant_index = self._read_byte()
-        return self.chunk.constants[constant_index]
+        return self.chunk.get_constant(constant_index)
+
+    def _read_constant_long(self):
+        constant_index = self._read_byte()
+        constant_index |= self._read_byte() << 8
+        constant_index |= self._read_byte() << 16
+        return self.chunk.get_constant(constant_index)
 
     @specialize.arg(1)
     def _binary_op(self, operator):
@@ -119,3 +484,41 @@ class VM(object):
         op1 = self._stack_pop()
         result = operator(op1, op2)
         self._stack_push(result)
+
+    @specialize.arg(1)
+    def _binary_const_op(self, operator):
+        # The right operand comes from the constant pool, so there is one
+        # pop and push fewer than OP_CONSTANT then the binary op.
+        op2 = self._read_constant()
+        op1 = self._stack_pop()
+        self._stack_push(operator(op1, op2))
+
+
+def _build_dispatch_table():
+    table = [None] * (max(OpCodeToInstructionName) + 1)
+    for opcode, name in OpCodeToInstructionName.items():
+        table[opcode] = VM.__dict__["_" + name.lower()]
+    return table
+
+
+dispatch_table = _build_dispatch_table()
+
+DISPATCH_STRATEGIES = ["switch", "table"]
+
+
+def select_dispatch(args):
+    """
+    Pick the opcode dispatch strategy from a target's translation
+    arguments, e.g. `rpython targetcalc.py --dispatch=table`.
+    Returns the remaining arguments.
+    """
+    remaining = []
+    for arg in args:
+        if arg.startswith("--dispatch="):
+            strategy = arg[len("--dispatch="):]
+            if strategy not in DISPATCH_STRATEGIES:
+                raise ValueError("unknown dispatch strategy %r" % strategy)
+            VM.DISPATCH_TABLE = strategy == "table"
+        else:
+            remaining.append(arg)
+    return remaining